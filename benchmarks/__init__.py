@@ -0,0 +1,4 @@
+"""
+    Benchmarks for the desktopchanger package. Each module can be run
+    from the project folder with python -m benchmarks.<module>.
+"""
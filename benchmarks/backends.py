@@ -0,0 +1,72 @@
+"""
+    Measures the latency of a WallpaperChanger read and apply through
+    each desktop backend. The fake backend always runs, the subprocess
+    and D-Bus backends only when xfconf is reachable. The wallpaper is
+    switched between two files so every apply writes the property.
+
+    python -m benchmarks.backends
+"""
+
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from desktopchanger.backends import BackendError, FakeBackend, get_backend
+from desktopchanger.desktopchanger import WallpaperChanger
+
+REPEATS = {'fake': 10000, 'dbus': 200, 'subprocess': 50}
+
+##### Functions
+#####
+def available_backends():
+    """
+        Returns a dict of backend name to backend for every backend that
+        can be used here.
+    """
+    backends = {'fake': FakeBackend(
+        {WallpaperChanger.wallpaper_property: ''})}
+    try:
+        backends['dbus'] = get_backend('dbus')
+    except (ImportError, BackendError) as e_info:
+        print("Skipping dbus: " + str(e_info))
+    if shutil.which('xfconf-query'):
+        backends['subprocess'] = get_backend('subprocess')
+    else:
+        print("Skipping subprocess: xfconf-query not found")
+    return backends
+
+def apply_latency(backend, wallpapers, repeats):
+    """
+        Returns the mean seconds of reading the current wallpaper and
+        applying a new one.
+    """
+    start = time.perf_counter()
+    for i in range(repeats):
+        changer = WallpaperChanger(wallpapers[i % 2], backend)
+        changer.apply_new_wallpaper()
+    return (time.perf_counter() - start) / repeats
+
+def run():
+    """
+        Runs the benchmark for every available backend.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        wallpapers = [Path(folder, name) for name in ('a.jpg', 'b.jpg')]
+        for wallpaper in wallpapers:
+            wallpaper.touch()
+        backends = available_backends()
+        # put back the real wallpaper afterwards
+        previous = {name: backend.read(WallpaperChanger.wallpaper_property)
+                    for name, backend in backends.items()}
+        for name, backend in backends.items():
+            latency = apply_latency(backend, wallpapers, REPEATS[name])
+            print("{0:>12}: {1:10.1f} us per read and apply".format(
+                name, latency*1e6))
+            if os.path.isfile(previous[name]):
+                backend.write(WallpaperChanger.wallpaper_property, previous[name])
+
+##### Main
+#####
+if __name__ == "__main__":
+    run()
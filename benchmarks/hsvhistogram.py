@@ -0,0 +1,92 @@
+"""
+    Micro-benchmark comparing the single pass histogram engine of
+    Image against the original mask based implementation. Both are run
+    on the same random images, the results are checked to be identical
+    and the time per megapixel of each is printed.
+
+    python -m benchmarks.hsvhistogram
+"""
+
+import time
+import numpy as np
+import cv2
+from desktopchanger.imageanalysis import Image
+
+# image sizes (height, width) to benchmark
+SIZES = [(1080, 1920), (2160, 3840), (4320, 7680)]
+REPEATS = 5
+
+##### Functions
+#####
+def masked_metrics(hsv):
+    """
+        The original inRange/countNonZero implementation of
+        primary_hues and value_gradient, kept as the reference.
+        Returns blue, green, red, light, dark fractions.
+    """
+    blue_hsv = cv2.inRange(hsv, np.array([104, 80, 80]), np.array([134, 255, 255]))
+    green_hsv = cv2.inRange(hsv, np.array([44, 80, 80]), np.array([74, 255, 255]))
+    red_hsv_low = cv2.inRange(hsv, np.array([0, 80, 80]), np.array([14, 255, 255]))
+    red_hsv_high = cv2.inRange(hsv, np.array([164, 80, 80]), np.array([179, 255, 255]))
+    red_hsv = cv2.bitwise_or(red_hsv_low, red_hsv_high)
+    light_hsv = cv2.inRange(hsv, np.array([0, 0, 170]), np.array([255, 255, 255]))
+    dark_hsv = cv2.inRange(hsv, np.array([0, 0, 0]), np.array([255, 255, 80]))
+    height, width, _ = hsv.shape
+    size = height*width
+    return tuple(cv2.countNonZero(mask)/size for mask in
+                 (blue_hsv, green_hsv, red_hsv, light_hsv, dark_hsv))
+
+def histogram_metrics(image):
+    """
+        The histogram engine. The cached histogram is cleared so every
+        call builds it again.
+    """
+    image.hist = None
+    blue, green, red = image.primary_hues()
+    light, dark = image.value_gradient()
+    return blue, green, red, light, dark
+
+def make_image(height, width, seed):
+    """
+        Returns an Image holding smoothed random noise so that every
+        hue, saturation and value occurs.
+    """
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    img = cv2.GaussianBlur(img, (0, 0), 1.5)
+    image = Image.__new__(Image)
+    image.img = img
+    image.convert_hsv()
+    return image
+
+def best_time(function, *args):
+    """
+        Returns the result and the fastest of REPEATS runs in seconds.
+    """
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+def run():
+    """
+        Runs the benchmark for every size and prints the results.
+    """
+    print("{0:>12} {1:>12} {2:>12} {3:>8}".format(
+        "megapixels", "masks ms/MP", "hist ms/MP", "speedup"))
+    for seed, (height, width) in enumerate(SIZES):
+        image = make_image(height, width, seed)
+        megapixels = height*width/1e6
+        expected, masked = best_time(masked_metrics, image.hsv)
+        result, histogram = best_time(histogram_metrics, image)
+        assert result == expected, (result, expected)
+        print("{0:>12.1f} {1:>12.2f} {2:>12.2f} {3:>7.2f}x".format(
+            megapixels, masked*1000/megapixels,
+            histogram*1000/megapixels, masked/histogram))
+
+##### Main
+#####
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,79 @@
+"""
+    Start-up budget check for updatedesktop.py. A fresh interpreter
+    imports desktopchanger.desktopchanger and picks a wallpaper from a
+    small catalog. The check fails with exit status 1 if pandas or
+    OpenCV were imported or if the fastest start-up is over the budget.
+
+    python -m benchmarks.importbudget
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+
+# seconds allowed for the import and wallpaper choice
+BUDGET = 0.25
+REPEATS = 5
+# modules which must not be loaded on the fast start path
+HEAVY_MODULES = ['pandas', 'cv2']
+
+CONFIG = """csvFile: 'wallpapers.csv'
+latitude: 51.5
+longitude: 0.1
+"""
+CATALOG = """path,blue,green,red,light,dark
+/night.jpg,0.05,0.1,0.1,0.5,0.2
+/day.jpg,0.5,0.1,0.1,0.5,0.2
+"""
+# run in the child interpreter, prints the elapsed time and heavy modules
+CHILD = """
+import time
+start = time.perf_counter()
+import argparse, sys
+from desktopchanger.desktopchanger import DesktopChanger
+changer = DesktopChanger(argparse.Namespace(image=None))
+changer.select_wallpaper(changer.load_csv())
+elapsed = time.perf_counter() - start
+print(elapsed, ' '.join(m for m in {0!r} if m in sys.modules))
+"""
+
+##### Functions
+#####
+def startup_time(folder):
+    """
+        Runs the child interpreter once in folder. Returns the elapsed
+        seconds and a list of heavy modules which were loaded.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.getcwd(), env.get('PYTHONPATH', '')])
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD.format(HEAVY_MODULES)],
+        cwd=folder, env=env)
+    elapsed, *loaded = output.decode().split()
+    return float(elapsed), loaded
+
+def run():
+    """
+        Measures the start-up REPEATS times and checks the fastest run.
+        Returns True if the budget was met.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        os.mkdir(os.path.join(folder, 'data'))
+        with open(os.path.join(folder, 'config.yaml'), 'w') as f:
+            f.write(CONFIG)
+        with open(os.path.join(folder, 'data', 'wallpapers.csv'), 'w') as f:
+            f.write(CATALOG)
+        results = [startup_time(folder) for _ in range(REPEATS)]
+    fastest = min(elapsed for elapsed, _ in results)
+    loaded = set(module for _, modules in results for module in modules)
+    print("Fastest start-up: {0:.3f} s (budget {1:.3f} s)".format(fastest, BUDGET))
+    if loaded:
+        print("Heavy modules imported: " + ', '.join(sorted(loaded)))
+    return fastest <= BUDGET and not loaded
+
+##### Main
+#####
+if __name__ == "__main__":
+    sys.exit(0 if run() else 1)
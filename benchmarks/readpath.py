@@ -0,0 +1,103 @@
+"""
+    Compares the scanner's image read paths: cv2.imread, memory mapped
+    files decoded with cv2.imdecode, and both with read-ahead of the
+    next files. Each path is timed on a cold page cache, with the files
+    dropped from the cache by posix_fadvise(POSIX_FADV_DONTNEED), and
+    then on a warm one. Exits with status 1 if any path gives different
+    results from imread.
+    Run it with --folder on the storage to measure, for example an NFS
+    mounted share; dropping pages from the cache does nothing on tmpfs.
+
+    python -m benchmarks.readpath [--folder FOLDER] [--count 32]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import cv2
+from desktopchanger.imagereader import readahead
+from desktopchanger.wallpapersearch import analyse_image
+
+# (width, height) of the corpus images, cycled through
+RESOLUTIONS = [(3840, 2160), (1920, 1080)]
+FORMATS = [".jpg", ".png"]
+READ_AHEAD = 8
+# name, mapped, read-ahead depth
+PATHS = [("imread", False, 0), ("mmap", True, 0),
+         ("imread + read-ahead", False, READ_AHEAD),
+         ("mmap + read-ahead", True, READ_AHEAD)]
+
+##### Functions
+#####
+def make_corpus(folder, count):
+    """
+        Writes count images of smoothed noise to folder, synced to disk
+        so their pages can be dropped from the cache. Returns the paths.
+    """
+    rng = np.random.default_rng(2019)
+    paths = []
+    for i in range(count):
+        width, height = RESOLUTIONS[i % len(RESOLUTIONS)]
+        extension = FORMATS[i % len(FORMATS)]
+        img = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+        img = cv2.resize(img, (width, height), interpolation=cv2.INTER_CUBIC)
+        path = os.path.join(folder, "image{0:03d}{1}".format(i, extension))
+        cv2.imwrite(path, img)
+        with open(path, 'rb') as f:
+            os.fsync(f.fileno())
+        paths.append(path)
+    return paths
+
+def drop_cache(paths):
+    """
+        Asks the kernel to drop the cached pages of every file.
+    """
+    for path in paths:
+        with open(path, 'rb') as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def scan(paths, mapped, depth):
+    """
+        Analyses every file in order as the scanner does and returns the
+        elapsed seconds and the results.
+    """
+    start = time.perf_counter()
+    results = [analyse_image(path, mapped=mapped)
+               for path, _ in readahead(((path, None) for path in paths), depth)]
+    return time.perf_counter() - start, results
+
+##### Main
+#####
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--folder",
+                        help="Folder to write the corpus in, a temporary folder by default.")
+    parser.add_argument("-n", "--count", type=int, default=32,
+                        help="Number of images in the corpus.")
+    args = parser.parse_args()
+    if not hasattr(os, 'posix_fadvise'):
+        print("posix_fadvise is needed to empty the page cache")
+        sys.exit(1)
+    FAILED = False
+    with tempfile.TemporaryDirectory(dir=args.folder) as folder:
+        paths = make_corpus(folder, args.count)
+        megabytes = sum(os.path.getsize(path) for path in paths) / 2**20
+        print("{0} images, {1:.0f} MB in {2}".format(len(paths), megabytes, folder))
+        expected = None
+        for name, mapped, depth in PATHS:
+            drop_cache(paths)
+            cold, results = scan(paths, mapped, depth)
+            warm, _ = scan(paths, mapped, depth)
+            if expected is None:
+                expected = results
+            same = results == expected
+            FAILED = FAILED or not same
+            print("{0:>20}: cold {1:6.1f} images/s {2:7.1f} MB/s, "
+                  "warm {3:6.1f} images/s {4:7.1f} MB/s {5}".format(
+                      name, len(paths) / cold, megabytes / cold,
+                      len(paths) / warm, megabytes / warm,
+                      "identical" if same else "DIFFERENT"))
+    sys.exit(1 if FAILED else 0)
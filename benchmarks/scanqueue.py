@@ -0,0 +1,93 @@
+"""
+    Checks that the scan keeps its queue of images bounded, so that
+    memory stays flat and rows reach the catalog as the walk goes on.
+    A folder of small synthetic images is scanned once, then rescanned
+    incrementally with no changes, where every row is reused, and with
+    the analysis cache, where every image is a cache hit. The queue
+    length is read from outside, as the images the scan has taken from
+    the walk minus the rows it has yielded. Exits with status 1 if it
+    is ever above workers * QUEUE_PER_WORKER.
+
+    python -m benchmarks.scanqueue [--count 200]
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+import cv2
+from desktopchanger.wallpapersearch import WallpaperSearch, QUEUE_PER_WORKER
+
+WORKERS = [1, 2]
+CONFIG = """wallpapersFolder: '{0}'
+csvFile: 'wallpapers.csv'
+catalog: csv
+analysisCache: 'analysis.db'
+"""
+
+##### Functions
+#####
+def make_corpus(folder, count):
+    """
+        Writes count small JPEG images of random noise to folder.
+    """
+    rng = np.random.default_rng(2013)
+    for i in range(count):
+        img = rng.integers(0, 256, (60, 80, 3), dtype=np.uint8)
+        cv2.imwrite(os.path.join(folder, "image{0:04d}.jpg".format(i)), img)
+
+def longest_queue(search):
+    """
+        Runs the scan of search without writing a catalog and returns
+        the longest its queue was and the number of rows.
+    """
+    state = {'taken': 0, 'yielded': 0, 'longest': 0}
+
+    def walk():
+        for item in search.process_path():
+            # the queue as it is before the scan takes the next image
+            state['longest'] = max(state['longest'], state['taken'] - state['yielded'])
+            state['taken'] += 1
+            yield item
+
+    for _ in search.process_images(walk()):
+        state['yielded'] += 1
+    return state['longest'], state['yielded']
+
+##### Main
+#####
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=200,
+                        help="Number of images in the corpus.")
+    args = parser.parse_args()
+    FAILED = False
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        corpus = os.path.join(folder, "wallpapers")
+        for name in ("data", "wallpapers"):
+            os.makedirs(os.path.join(folder, name))
+        with open(os.path.join(folder, "config.yaml"), 'w') as f:
+            f.write(CONFIG.format(corpus))
+        make_corpus(corpus, args.count)
+        os.chdir(folder)
+        try:
+            WallpaperSearch(argparse.Namespace(folder=None, workers=1)).search_folder()
+            for workers in WORKERS:
+                limit = workers * QUEUE_PER_WORKER
+                for name, incremental in (("no-change rescan", True), ("cache hits", False)):
+                    search = WallpaperSearch(argparse.Namespace(
+                        folder=None, workers=workers, incremental=incremental))
+                    if incremental:
+                        search.load_previous()
+                    longest, rows = longest_queue(search)
+                    passed = longest <= limit and rows == args.count
+                    FAILED = FAILED or not passed
+                    print("{0:>17} workers {1}: {2} rows, longest queue {3} "
+                          "(limit {4}) {5}".format(
+                              name, workers, rows, longest, limit,
+                              "ok" if passed else "FAILED"))
+        finally:
+            os.chdir(cwd)
+    sys.exit(1 if FAILED else 0)
@@ -0,0 +1,148 @@
+"""
+    Load test of the wallpaper selection service. The service is started
+    in its own process on a synthetic catalog and several client
+    processes send requests for a few seconds, first each over one
+    persistent connection and then with a new connection per request,
+    as updatedesktop.py --client does. Exits with status 1 if either
+    rate is below MINIMUM_RATE requests per second.
+
+    python -m benchmarks.serviceload
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from desktopchanger.utils import FIELDNAMES
+from desktopchanger.service import SelectionService, request_wallpapers
+
+CATALOG_SIZE = 100000
+CLIENTS = 4
+DURATION = 3.0
+MINIMUM_RATE = 1000
+MONITORS = ["/backdrop/screen0/monitor{0}/workspace0/last-image".format(i)
+            for i in range(2)]
+# client locations, so night and day buckets are both used
+LOCATIONS = [(51.5, -0.1), (40.7, -74.0), (35.7, 139.7), (-33.9, 151.2)]
+
+##### Functions
+#####
+def write_catalog(folder, size):
+    """
+        Writes a config.yaml and a csv catalog of size random rows in
+        folder, laid out as the service expects.
+    """
+    os.makedirs(os.path.join(folder, "data"))
+    rng = random.Random(0)
+    with open(os.path.join(folder, "data", "wallpapers.csv"), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        for i in range(size):
+            night = rng.random() < 0.5
+            writer.writerow({
+                'path': "/srv/wallpapers/{0:03d}/image{1:07d}.jpg".format(i % 997, i),
+                'blue': 0.1 if night else 0.4, 'green': 0.2,
+                'red': 0.4 if night else 0.1, 'light': 0.3, 'dark': 0.3,
+                'size': 1000000, 'mtime': 0, 'night': int(night), 'features': ''})
+    with open(os.path.join(folder, "config.yaml"), 'w') as f:
+        f.write("csvFile: 'wallpapers.csv'\ncatalog: csv\n")
+
+def wait_for(socket_path, process, timeout=60):
+    """
+        Waits until the service answers on socket_path.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("selection service exited")
+        try:
+            request_wallpapers(socket_path, 0.0, 0.0, MONITORS)
+            return
+        except (FileNotFoundError, ConnectionError):
+            time.sleep(0.05)
+    raise RuntimeError("selection service did not start")
+
+def persistent_client(socket_path, seed):
+    """
+        Sends requests over one connection for DURATION seconds and
+        returns the number answered.
+    """
+    latitude, longitude = LOCATIONS[seed % len(LOCATIONS)]
+    request = json.dumps({'latitude': latitude, 'longitude': longitude,
+                          'monitors': MONITORS}).encode() + b'\n'
+    answered = 0
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        stream = client.makefile('rb')
+        deadline = time.monotonic() + DURATION
+        while time.monotonic() < deadline:
+            client.sendall(request)
+            if 'wallpapers' not in json.loads(stream.readline()):
+                raise RuntimeError("selection service answered with an error")
+            answered += 1
+    return answered
+
+def connecting_client(socket_path, seed):
+    """
+        Sends requests on a new connection each for DURATION seconds and
+        returns the number answered.
+    """
+    latitude, longitude = LOCATIONS[seed % len(LOCATIONS)]
+    answered = 0
+    deadline = time.monotonic() + DURATION
+    while time.monotonic() < deadline:
+        request_wallpapers(socket_path, latitude, longitude, MONITORS)
+        answered += 1
+    return answered
+
+def load(client, socket_path):
+    """
+        Runs CLIENTS client processes at once and returns requests per
+        second over all of them.
+    """
+    with multiprocessing.Pool(CLIENTS) as pool:
+        start = time.perf_counter()
+        answered = pool.starmap(client, [(socket_path, seed) for seed in range(CLIENTS)])
+        elapsed = time.perf_counter() - start
+    return sum(answered) / elapsed
+
+##### Main
+#####
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        SelectionService(argparse.Namespace(socket=args.serve)).serve()
+        sys.exit(0)
+    FAILED = False
+    with tempfile.TemporaryDirectory() as folder:
+        write_catalog(folder, CATALOG_SIZE)
+        socket_path = os.path.join(folder, "selection.sock")
+        environment = dict(os.environ, PYTHONPATH=os.getcwd())
+        service = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.serviceload", "--serve", socket_path],
+            cwd=folder, env=environment)
+        try:
+            start = time.perf_counter()
+            wait_for(socket_path, service)
+            print("catalog of {0} wallpapers loaded in {1:.2f} s".format(
+                CATALOG_SIZE, time.perf_counter() - start))
+            for name, client in (("persistent connections", persistent_client),
+                                 ("connection per request", connecting_client)):
+                rate = load(client, socket_path)
+                passed = rate >= MINIMUM_RATE
+                FAILED = FAILED or not passed
+                print("{0:>24}: {1:8.0f} requests/s {2}".format(
+                    name, rate, "ok" if passed else "BELOW {0}".format(MINIMUM_RATE)))
+        finally:
+            service.terminate()
+            service.wait()
+    sys.exit(1 if FAILED else 0)
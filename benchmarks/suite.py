@@ -0,0 +1,284 @@
+"""
+    Benchmark suite with a reproducible synthetic image corpus. It
+    measures:
+        * ImageAnalysis.analyse_hsv latency per image
+        * WallpaperSearch.search_folder time per image
+        * DesktopChanger.select_wallpaper and load_csv latency for
+          catalogs of 1k to 1M rows
+        * FeatureIndex nearest neighbour selection for the same sizes,
+          both working out a daylight level and picking from it
+        * ShuffleBag next wallpaper for the same sizes
+        * SunEquation.calculate time
+    Every result is in seconds, lower is better. Results are written as
+    json and compared against a stored baseline; a result slower than
+    the baseline by more than the tolerance is a regression and the
+    exit status is 1.
+
+    python -m benchmarks.suite [--output results.json]
+        [--baseline benchmarks/baseline.json] [--update-baseline]
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import cv2
+from desktopchanger.desktopchanger import DesktopChanger
+from desktopchanger.imageanalysis import ImageAnalysis
+from desktopchanger.selection import FeatureIndex, FEATURE_BINS
+from desktopchanger.shufflebag import ShuffleBag
+from desktopchanger.sunequation import SunEquation
+from desktopchanger.utils import FIELDNAMES, CSVFileIO
+from desktopchanger.wallpapersearch import WallpaperSearch
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+SEED = 2019
+# (width, height) of the corpus images
+RESOLUTIONS = [(640, 360), (1920, 1080), (3840, 2160)]
+FORMATS = [".jpg", ".png"]
+DISTRIBUTIONS = ["day", "night", "gradient", "noise"]
+CATALOG_SIZES = [1000, 10000, 100000, 1000000]
+REPEATS = 5
+CONFIG = """wallpapersFolder: {folder}
+csvFile: 'wallpapers.csv'
+latitude: 51.5
+longitude: 0.1
+"""
+
+##### Functions
+#####
+def make_image(width, height, distribution, rng):
+    """
+        Returns a BGR image with a colour distribution:
+            * day: bright blues with soft shapes
+            * night: dark reds with a few bright lights
+            * gradient: a smooth gradient across the hue circle
+            * noise: smoothed random noise over every colour
+    """
+    if distribution == "noise":
+        img = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        return cv2.GaussianBlur(img, (0, 0), 2)
+    if distribution == "gradient":
+        hsv = np.empty((height, width, 3), np.uint8)
+        hsv[..., 0] = np.linspace(0, 179, width, dtype=np.uint8)
+        hsv[..., 1] = np.linspace(40, 255, height, dtype=np.uint8)[:, None]
+        hsv[..., 2] = 200
+        return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    base = (200, 150, 60) if distribution == "day" else (10, 10, 60)
+    img = np.empty((height, width, 3), np.uint8)
+    img[:] = base
+    for _ in range(20):
+        centre = (int(rng.integers(width)), int(rng.integers(height)))
+        radius = int(rng.integers(height // 20, height // 4))
+        colour = tuple(int(value) for value in rng.integers(0, 256, 3))
+        cv2.circle(img, centre, radius, colour, -1)
+    return cv2.GaussianBlur(img, (0, 0), 3)
+
+def make_corpus(folder):
+    """
+        Writes the synthetic corpus to folder and returns the list of
+        (name, path) pairs. The same seed always gives the same images.
+    """
+    rng = np.random.default_rng(SEED)
+    corpus = []
+    for width, height in RESOLUTIONS:
+        for distribution in DISTRIBUTIONS:
+            img = make_image(width, height, distribution, rng)
+            for extension in FORMATS:
+                name = "{0}x{1}_{2}{3}".format(width, height, distribution, extension)
+                path = os.path.join(folder, name)
+                cv2.imwrite(path, img)
+                corpus.append((name, path))
+    return corpus
+
+def best_time(function, repeats=REPEATS, number=1):
+    """
+        Times number calls of function, repeats times, and returns the
+        fastest time per call in seconds. Taking the fastest run keeps
+        the noise of a busy machine out of the results.
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+    return min(timings)
+
+def bench_analysis(corpus):
+    """
+        ImageAnalysis.analyse_hsv latency of each corpus image, from
+        decode to the five fractions.
+    """
+    return {"analyse_hsv/" + name: best_time(
+        lambda path=path: ImageAnalysis(path).analyse_hsv())
+            for name, path in corpus}
+
+def bench_search(folder, corpus):
+    """
+        WallpaperSearch.search_folder time per image over the corpus.
+    """
+    args = argparse.Namespace(folder=folder, workers=1, incremental=False,
+                              scale=None, watch=False)
+    elapsed = best_time(lambda: WallpaperSearch(args).search_folder(), 1)
+    return {"search_folder/per_image": elapsed / len(corpus)}
+
+def write_catalog(rows):
+    """
+        Writes a synthetic catalog of rows wallpapers, about a third of
+        them night wallpapers.
+    """
+    rng = random.Random(SEED)
+    def catalog():
+        for i in range(rows):
+            night = i % 3 == 0
+            yield {'path': "/wallpapers/{0}.jpg".format(i),
+                   'blue': 0.05 if night else round(rng.random(), 3),
+                   'green': round(rng.random(), 3),
+                   'red': 0.1 if night else round(rng.random(), 3),
+                   'light': 0.5, 'dark': round(rng.random(), 3),
+                   'size': 1000 + i, 'mtime': i, 'night': int(night)}
+    CSVFileIO('wallpapers.csv').write_rows(catalog(), FIELDNAMES)
+
+def bench_selection():
+    """
+        DesktopChanger.load_csv and select_wallpaper latency for each
+        catalog size. Runs in a folder holding config.yaml and data/.
+    """
+    results = {}
+    changer = DesktopChanger(argparse.Namespace(image=None))
+    for rows in CATALOG_SIZES:
+        write_catalog(rows)
+        partitions = changer.load_csv()
+        results["load_csv/{0}".format(rows)] = best_time(changer.load_csv, 1)
+        results["select_wallpaper/{0}".format(rows)] = best_time(
+            lambda: changer.select_wallpaper(partitions), number=10000)
+    return results
+
+def bench_nearest():
+    """
+        FeatureIndex latency for each catalog size of random feature
+        vectors: the first selection at a daylight level, which finds
+        its k nearest images, and the selections after it.
+    """
+    results = {}
+    rng = np.random.default_rng(SEED)
+    for rows in CATALOG_SIZES:
+        features = rng.random((rows, FEATURE_BINS), np.float32).astype(np.float16)
+        index = FeatureIndex([str(i) for i in range(rows)], features)
+        results["nearest_level/{0}".format(rows)] = best_time(
+            lambda: index.nearest(index.target(0.5)))
+        results["nearest_select/{0}".format(rows)] = best_time(
+            lambda: index.select(0.5), number=10000)
+    return results
+
+def bench_shuffle():
+    """
+        ShuffleBag.next latency for each catalog size, once the bag has
+        been built. Runs in a folder holding data/.
+    """
+    results = {}
+    for rows in CATALOG_SIZES:
+        bag = ShuffleBag(os.path.join("data", "bench_{0}.bag".format(rows)))
+        ids = range(rows)
+        bag.next((rows, 0), lambda: ids)
+        results["shuffle_next/{0}".format(rows)] = best_time(
+            lambda: bag.next((rows, 0), lambda: ids), number=min(rows - 1, 1000))
+    return results
+
+def bench_sun():
+    """
+        SunEquation.calculate time for one day.
+    """
+    return {"sun_equation/calculate": best_time(
+        lambda: SunEquation(51.5, 0.1).calculate(), number=200)}
+
+def run_suite():
+    """
+        Runs every benchmark in a temporary folder and returns the
+        results dict.
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        corpus_folder = os.path.join(folder, "corpus")
+        os.mkdir(corpus_folder)
+        os.mkdir(os.path.join(folder, "data"))
+        Path(folder, "config.yaml").write_text(CONFIG.format(folder=corpus_folder))
+        corpus = make_corpus(corpus_folder)
+        os.chdir(folder)
+        try:
+            results = {}
+            results.update(bench_analysis(corpus))
+            results.update(bench_search(corpus_folder, corpus))
+            results.update(bench_selection())
+            results.update(bench_nearest())
+            results.update(bench_shuffle())
+            results.update(bench_sun())
+        finally:
+            os.chdir(cwd)
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+        Prints each result against the baseline and returns the names of
+        results slower than the baseline by more than tolerance.
+    """
+    regressions = []
+    for name, value in sorted(results.items()):
+        reference = baseline.get(name)
+        if reference:
+            ratio = value / reference
+            flag = "REGRESSION" if ratio > 1 + tolerance else ""
+            print("{0:40} {1:12.6f} s {2:6.2f}x {3}".format(name, value, ratio, flag))
+            if flag:
+                regressions.append(name)
+        else:
+            print("{0:40} {1:12.6f} s    new".format(name, value))
+    return regressions
+
+def cmd_arguments():
+    """
+        taking CMD arguments and sending them through the argument
+        parser.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="bench_output.json",
+                        help="File the json results are written to.")
+    parser.add_argument("-b", "--baseline", default=BASELINE,
+                        help="Baseline json results to compare against.")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.5,
+                        help="Allowed slowdown against the baseline, 0.5 is 50%%.")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Store these results as the new baseline.")
+    return parser.parse_args()
+
+##### Main
+#####
+if __name__ == "__main__":
+    ARGS = cmd_arguments()
+    logging.disable(logging.WARNING)
+    RESULTS = run_suite()
+    OUTPUT = {"platform": platform.platform(), "python": platform.python_version(),
+              "results": RESULTS}
+    with open(ARGS.output, 'w') as f:
+        json.dump(OUTPUT, f, indent=2, sort_keys=True)
+    if ARGS.update_baseline:
+        with open(ARGS.baseline, 'w') as f:
+            json.dump(OUTPUT, f, indent=2, sort_keys=True)
+        print("Baseline written to " + ARGS.baseline)
+        sys.exit(0)
+    BASELINE_RESULTS = {}
+    if os.path.isfile(ARGS.baseline):
+        with open(ARGS.baseline) as f:
+            BASELINE_RESULTS = json.load(f)["results"]
+    REGRESSIONS = compare(RESULTS, BASELINE_RESULTS, ARGS.tolerance)
+    if REGRESSIONS:
+        print("Regressions: " + ", ".join(REGRESSIONS))
+    sys.exit(1 if REGRESSIONS else 0)
@@ -0,0 +1,54 @@
+"""
+    Checks SunEquation.calculate_range against the scalar calculate
+    for every day of a year at several locations and compares the time
+    taken by each. Exits with status 1 if any day differs.
+
+    python -m benchmarks.suntable
+"""
+
+import datetime
+import logging
+import sys
+import time
+from desktopchanger.sunequation import SunEquation
+
+# (latitude, longitude) pairs to check
+LOCATIONS = [(51.5, 0.1), (-41.3, -174.8), (60.2, 24.9), (19.4, 99.1)]
+YEAR = 2024
+
+##### Functions
+#####
+def run():
+    """
+        Runs the comparison for each location and prints the timings.
+        Returns True if every day matched.
+    """
+    # the scalar path logs every step, keep it quiet while timing
+    logging.disable(logging.DEBUG)
+    start_date = datetime.date(YEAR, 1, 1)
+    end_date = datetime.date(YEAR, 12, 31)
+    matched = True
+    print("{0:>16} {1:>10} {2:>10} {3:>10}".format(
+        "location", "scalar ms", "vector ms", "mismatch"))
+    for latitude, longitude in LOCATIONS:
+        start = time.perf_counter()
+        dates, rises, sets = SunEquation(latitude, longitude).calculate_range(
+            start_date, end_date)
+        vector = time.perf_counter() - start
+        start = time.perf_counter()
+        mismatches = 0
+        for date, rise, fall in zip(dates, rises, sets):
+            sun_times = SunEquation(latitude, longitude, date)
+            if sun_times.calculate() != (rise, fall):
+                mismatches += 1
+        scalar = time.perf_counter() - start
+        matched = matched and mismatches == 0
+        print("{0:>16} {1:>10.1f} {2:>10.1f} {3:>10}".format(
+            "{0},{1}".format(latitude, longitude),
+            scalar*1000, vector*1000, mismatches))
+    return matched
+
+##### Main
+#####
+if __name__ == "__main__":
+    sys.exit(0 if run() else 1)
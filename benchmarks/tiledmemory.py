@@ -0,0 +1,113 @@
+"""
+    Checks that the tiled analysis of Image gives exactly the results
+    of the whole image analysis, and compares the peak memory of both.
+    Each analysis runs in its own process on a large synthetic image so
+    that its peak resident memory can be read (Linux only). Caps too
+    small for the full image decode it at a reduced scale or skip it.
+    Exits with status 1 if any result at full scale differs.
+
+    python -m benchmarks.tiledmemory
+"""
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+import numpy as np
+import cv2
+from desktopchanger.imageanalysis import ImageAnalysis
+
+# (height, width) of the test images, the largest is 48 megapixels
+SIZES = [(1080, 1920), (3000, 4000), (6000, 8000)]
+FORMATS = [".jpg", ".png"]
+# image content: smoothed noise covering every colour, or all black
+KINDS = ["noise", "black"]
+# memory caps in megabytes, None is the whole image path
+CAPS = [None, 256, 64, 8]
+
+##### Functions
+#####
+def make_image(path, height, width, kind, seed):
+    """
+        Writes an image of smoothed random noise so that every hue,
+        saturation and value occurs, or an all black image, whose
+        decoded pixels are all zero.
+    """
+    if kind == "black":
+        cv2.imwrite(path, np.zeros((height, width, 3), np.uint8))
+        return
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    cv2.imwrite(path, cv2.GaussianBlur(img, (0, 0), 1.5))
+
+def peak_memory():
+    """
+        Returns the peak resident memory of this process in megabytes
+        from /proc. Unlike ru_maxrss it is not carried over from the
+        parent process.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def analyse(path, cap):
+    """
+        Runs one analysis in this process and prints its results, decode
+        scale and the peak resident memory in megabytes as json, or the
+        reason the image was skipped.
+    """
+    max_bytes = cap * 2**20 if cap else None
+    try:
+        image_analyse = ImageAnalysis(path, 1, max_bytes)
+    except ValueError as e_info:
+        print(json.dumps({'skipped': str(e_info), 'peak': peak_memory()}))
+        return
+    results = list(image_analyse.analyse_hsv())
+    features = image_analyse.analyse_features().tolist()
+    peak = peak_memory()
+    print(json.dumps({'results': results, 'features': features,
+                      'scale': image_analyse.image.scale, 'peak': peak}))
+
+def run(path, cap):
+    """
+        Runs analyse in a new process and returns its json output.
+    """
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.tiledmemory", path, str(cap or 0)],
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+##### Main
+#####
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        analyse(sys.argv[1], int(sys.argv[2]))
+        sys.exit(0)
+    FAILED = False
+    with tempfile.TemporaryDirectory() as folder:
+        for (height, width), kind, extension in \
+            [(size, kind, extension) for size in SIZES for kind in KINDS
+             for extension in FORMATS]:
+            name = "{0}x{1}-{2}{3}".format(width, height, kind, extension)
+            path = os.path.join(folder, name)
+            make_image(path, height, width, kind, height)
+            expected = None
+            for cap in CAPS:
+                output = run(path, cap)
+                if expected is None:
+                    expected = output
+                if 'skipped' in output:
+                    outcome = "skipped"
+                elif output['scale'] != 1:
+                    outcome = "decoded at 1/{0}".format(output['scale'])
+                else:
+                    same = output['results'] == expected['results'] \
+                        and output['features'] == expected['features']
+                    FAILED = FAILED or not same
+                    outcome = "identical" if same else "DIFFERENT"
+                print("{0:>20} cap {1:>5}: peak {2:8.1f} MB {3}".format(
+                    name, str(cap or "none"), output['peak'], outcome))
+    sys.exit(1 if FAILED else 0)
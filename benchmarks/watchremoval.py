@@ -0,0 +1,102 @@
+"""
+    Checks that watch mode removes an image from the catalog once the
+    pre-filter rejects it. wallpaperscan.py --watch is started on a
+    folder of synthetic images, then one image is truncated, one is
+    replaced by an image below minResolution and one is deleted. Exits
+    with status 1 if any of them is still in the catalog after TIMEOUT
+    seconds, or if the untouched images were dropped.
+
+    python -m benchmarks.watchremoval
+"""
+
+import os
+import sys
+import csv
+import time
+import tempfile
+import subprocess
+import numpy as np
+import cv2
+
+IMAGES = 6
+TIMEOUT = 30.0
+CONFIG = """wallpapersFolder: '{0}'
+csvFile: 'wallpapers.csv'
+catalog: csv
+minResolution: 200x100
+watchDebounce: 0.2
+"""
+
+##### Functions
+#####
+def write_image(path, height, width, seed):
+    """
+        Writes a JPEG of random noise.
+    """
+    rng = np.random.default_rng(seed)
+    cv2.imwrite(path, rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+def catalog_paths(folder):
+    """
+        Returns the set of paths in the csv catalog, empty until it is
+        written.
+    """
+    try:
+        with open(os.path.join(folder, "data", "wallpapers.csv"), newline='') as f:
+            return {row['path'] for row in csv.DictReader(f)}
+    except FileNotFoundError:
+        return set()
+
+def wait_for(folder, expected, process):
+    """
+        Waits until the catalog holds exactly the expected paths and
+        returns True, or False after TIMEOUT seconds.
+    """
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("wallpaperscan.py --watch exited")
+        if catalog_paths(folder) == expected:
+            return True
+        time.sleep(0.1)
+    return False
+
+##### Main
+#####
+if __name__ == "__main__":
+    FAILED = False
+    with tempfile.TemporaryDirectory() as folder:
+        images = os.path.join(folder, "wallpapers")
+        for name in ("data", "logs", "wallpapers"):
+            os.makedirs(os.path.join(folder, name))
+        with open(os.path.join(folder, "config.yaml"), 'w') as f:
+            f.write(CONFIG.format(images))
+        paths = [os.path.join(images, "image{0}.jpg".format(i)) for i in range(IMAGES)]
+        for i, path in enumerate(paths):
+            write_image(path, 300, 400, i)
+        environment = dict(os.environ, PYTHONPATH=os.getcwd())
+        watcher = subprocess.Popen(
+            [sys.executable, os.path.join(os.getcwd(), "wallpaperscan.py"), "--watch"],
+            cwd=folder, env=environment, stdout=subprocess.DEVNULL)
+        try:
+            if not wait_for(folder, set(paths), watcher):
+                raise RuntimeError("the first scan did not catalog every image")
+            truncated, small, deleted = paths[:3]
+            with open(truncated, 'r+b') as f:
+                f.truncate(os.path.getsize(truncated) // 2)
+            write_image(small, 50, 50, 0)
+            os.remove(deleted)
+            kept = set(paths[3:])
+            removed = wait_for(folder, kept, watcher)
+            FAILED = not removed
+            remaining = catalog_paths(folder)
+            for name, path in (("truncated", truncated), ("below minResolution", small),
+                               ("deleted", deleted)):
+                print("{0:>20}: {1}".format(
+                    name, "still catalogued" if path in remaining else "removed"))
+            print("{0:>20}: {1} of {2} catalogued".format(
+                "untouched", len(kept & remaining), len(kept)))
+        finally:
+            watcher.terminate()
+            watcher.wait()
+    sys.exit(1 if FAILED else 0)
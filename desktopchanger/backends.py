@@ -0,0 +1,242 @@
+"""
+    Desktop backends read and set the xfconf properties used by
+    WallpaperChanger.
+    * SubprocessBackend runs xfconf-query for each call. It needs nothing
+      but the xfconf command line tool and is the fallback. A batch of
+      writes runs its xfconf-query processes side by side.
+    * DBusBackend talks to the xfconf daemon over one persistent D-Bus
+      session connection, so a long running process pays no process
+      spawn per call. A batch of writes is sent in one round trip.
+      Needs the optional dbus-python package.
+    * FakeBackend keeps properties in memory so wallpaper changes can be
+      tested and benchmarked without a desktop session.
+    get_backend returns the backend named by the 'backend' key of
+    config.yaml.
+"""
+
+import os
+import logging
+import subprocess
+
+# xfconf channel holding the desktop properties
+CHANNEL = "xfce4-desktop"
+
+##### Functions
+#####
+def get_backend(name="auto"):
+    """
+        Returns a backend by name: 'dbus', 'subprocess', 'fake' or
+        'auto', which tries D-Bus and falls back to the subprocess
+        backend when dbus-python or the session bus is not available.
+    """
+    if name == "auto":
+        try:
+            return DBusBackend()
+        except (ImportError, BackendError) as e_info:
+            logging.debug("D-Bus backend unavailable, using subprocess: %s",
+                          str(e_info))
+            return SubprocessBackend()
+    backends = {
+        "dbus": DBusBackend,
+        "subprocess": SubprocessBackend,
+        "fake": FakeBackend,
+    }
+    if name not in backends:
+        raise ValueError("backend must be one of auto, " + ", ".join(backends))
+    return backends[name]()
+
+##### Classes
+#####
+class BackendError(Exception):
+    """
+        Raised when the desktop settings could not be read or written.
+    """
+
+class DesktopBackend:
+    """
+        Interface of a desktop backend. Properties are xfconf property
+        paths on CHANNEL and values are strings.
+    """
+    def read(self, prop):
+        """
+            Returns the value of a property.
+        """
+        raise NotImplementedError
+
+    def write(self, prop, value):
+        """
+            Sets a property to value.
+        """
+        raise NotImplementedError
+
+    def write_many(self, values):
+        """
+            Sets every property of a dict of property to value.
+        """
+        for prop, value in values.items():
+            self.write(prop, value)
+
+    def list_properties(self, prefix):
+        """
+            Returns a dict of every property under prefix and its value.
+        """
+        raise NotImplementedError
+
+class SubprocessBackend(DesktopBackend):
+    """
+        Runs xfconf-query for every read and write.
+    """
+    def read(self, prop):
+        """
+            Returns the value of a property from xfconf-query.
+        """
+        try:
+            output = subprocess.check_output(
+                ["xfconf-query", "--channel", CHANNEL, "--property", prop])
+        except subprocess.CalledProcessError as e_info:
+            print("subprocess did not run successfully. " + str(e_info))
+            raise
+        return output.strip().decode()
+
+    def write(self, prop, value):
+        """
+            Sets a property with xfconf-query.
+        """
+        cmd_output = subprocess.run(
+            ["xfconf-query", "--channel", CHANNEL, "--property", prop,
+             "--set", value], check=True)
+        logging.debug(cmd_output)
+
+    def write_many(self, values):
+        """
+            Sets every property of a dict of property to value. The
+            xfconf-query tool sets one property per run, so a process is
+            started for every property and all of them are waited for
+            together rather than one after another. Raises
+            CalledProcessError for the first that failed.
+        """
+        processes = [subprocess.Popen(
+            ["xfconf-query", "--channel", CHANNEL, "--property", prop, "--set", value])
+                     for prop, value in values.items()]
+        failed = None
+        for process in processes:
+            if process.wait() != 0 and failed is None:
+                failed = subprocess.CalledProcessError(process.returncode, process.args)
+        logging.debug("xfconf-query set %i properties", len(processes))
+        if failed is not None:
+            raise failed
+
+    def list_properties(self, prefix):
+        """
+            Returns the properties under prefix from xfconf-query.
+        """
+        try:
+            output = subprocess.check_output(
+                ["xfconf-query", "--channel", CHANNEL, "--property", prefix,
+                 "--list", "--verbose"])
+        except subprocess.CalledProcessError as e_info:
+            print("subprocess did not run successfully. " + str(e_info))
+            raise
+        properties = {}
+        for line in output.decode().splitlines():
+            parts = line.split(None, 1)
+            if parts:
+                properties[parts[0]] = parts[1] if len(parts) > 1 else ''
+        return properties
+
+class DBusBackend(DesktopBackend):
+    """
+        Reads and sets properties through the org.xfce.Xfconf D-Bus
+        service. The session bus connection is opened once and reused.
+    """
+    def __init__(self):
+        import dbus
+        self.dbus = dbus
+        try:
+            bus = dbus.SessionBus()
+            self.xfconf = dbus.Interface(
+                bus.get_object("org.xfce.Xfconf", "/org/xfce/Xfconf"),
+                "org.xfce.Xfconf")
+        except dbus.exceptions.DBusException as e_info:
+            raise BackendError(str(e_info))
+
+    def read(self, prop):
+        """
+            Returns the value of a property from the xfconf daemon.
+        """
+        try:
+            return str(self.xfconf.GetProperty(CHANNEL, prop))
+        except self.dbus.exceptions.DBusException as e_info:
+            raise BackendError(str(e_info))
+
+    def write(self, prop, value):
+        """
+            Sets a property through the xfconf daemon.
+        """
+        try:
+            self.xfconf.SetProperty(CHANNEL, prop, self.dbus.String(value))
+        except self.dbus.exceptions.DBusException as e_info:
+            raise BackendError(str(e_info))
+
+    def write_many(self, values):
+        """
+            Sets every property of a dict of property to value in one
+            round trip. The Xfconf interface sets one property per call,
+            so the calls are sent without waiting for their replies. The
+            daemon answers the calls of a connection in order, so reading
+            the properties back with one GetAllProperties call waits for
+            every set and shows any that failed, raised as BackendError.
+        """
+        if not values:
+            return
+        prefix = os.path.commonprefix(list(values)).rsplit('/', 1)[0] or '/'
+        try:
+            for prop, value in values.items():
+                self.xfconf.SetProperty(CHANNEL, prop, self.dbus.String(value),
+                                        ignore_reply=True)
+            stored = self.list_properties(prefix)
+        except self.dbus.exceptions.DBusException as e_info:
+            raise BackendError(str(e_info))
+        failed = [prop for prop, value in values.items() if stored.get(prop) != value]
+        if failed:
+            raise BackendError("Properties not set: " + ", ".join(failed))
+
+    def list_properties(self, prefix):
+        """
+            Returns the properties under prefix from the xfconf daemon.
+        """
+        try:
+            properties = self.xfconf.GetAllProperties(CHANNEL, prefix)
+        except self.dbus.exceptions.DBusException as e_info:
+            raise BackendError(str(e_info))
+        return {str(prop): str(value) for prop, value in properties.items()}
+
+class FakeBackend(DesktopBackend):
+    """
+        Keeps properties in a dict and records every write.
+    """
+    def __init__(self, properties=None):
+        self.properties = dict(properties or {})
+        self.writes = []
+
+    def read(self, prop):
+        """
+            Returns the stored value of a property.
+        """
+        if prop not in self.properties:
+            raise BackendError("Property " + prop + " does not exist")
+        return self.properties[prop]
+
+    def write(self, prop, value):
+        """
+            Stores the value of a property.
+        """
+        self.properties[prop] = value
+        self.writes.append((prop, value))
+
+    def list_properties(self, prefix):
+        """
+            Returns the stored properties under prefix.
+        """
+        return {prop: value for prop, value in self.properties.items()
+                if prop.startswith(prefix)}
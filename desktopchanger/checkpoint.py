@@ -0,0 +1,167 @@
+"""
+    Checkpoint of a folder scan in progress, so that a scan stopped by a
+    reboot, the OOM killer or Ctrl-C can be resumed with --resume instead
+    of starting again.
+    The checkpoint is a journal of json lines in data/: a header naming
+    the scanned folder and decode scale, then the catalog row of every
+    image finished and a line for every folder whose images are all
+    finished, with its subfolders. Lines are buffered and appended with
+    an fsync every interval seconds, so at most that much work is lost.
+    A torn last line left by a crash is cut off when the journal is read.
+    On resume the finished folders are not listed again and their rows
+    are taken from the journal. Rows of the other folders are reused if
+    the size and mtime of the file still match. The journal is removed
+    once the catalog has been written.
+"""
+
+import os
+import json
+import time
+import logging
+
+VERSION = 1
+
+##### Classes
+#####
+class ScanCheckpoint:
+    """
+        Journal of the rows and folders finished by one scan.
+    """
+    def __init__(self, path, interval=30):
+        self.path = path
+        self.interval = interval
+        self.file = None
+        self.lines = []
+        self.written = 0
+        # images still to finish per listed folder, with its subfolders
+        self.pending = {}
+
+    def load(self, folder, scale):
+        """
+            Reads the journal of an earlier scan of folder at scale.
+            Returns a dict of rows by path and a dict of the subfolders of
+            each finished folder. Both are empty if there is no journal or
+            it belongs to another scan.
+        """
+        rows = {}
+        folders = {}
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            logging.debug("No checkpoint to resume from")
+            return rows, folders
+        with f:
+            complete = 0
+            header = None
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                complete += len(line)
+                if header is None:
+                    header = entry
+                elif 'row' in entry:
+                    rows[entry['row']['path']] = entry['row']
+                elif 'folder' in entry:
+                    folders[entry['folder']] = entry['subfolders']
+        if header != self.header(folder, scale):
+            logging.warning("Checkpoint %s is of another scan, not resumed", self.path)
+            return {}, {}
+        # cut off a line torn by a crash before appending to the journal
+        os.truncate(self.path, complete)
+        logging.debug("Checkpoint rows: %i, finished folders: %i",
+                      len(rows), len(folders))
+        return rows, folders
+
+    @staticmethod
+    def header(folder, scale):
+        """
+            Returns the first entry of a journal for a scan of folder.
+        """
+        return {'checkpoint': VERSION, 'folder': str(folder), 'scale': scale}
+
+    def open(self, folder, scale, resume=False):
+        """
+            Starts a new journal, or appends to the one being resumed.
+        """
+        self.pending = {}
+        if resume and os.path.isfile(self.path):
+            self.file = open(self.path, 'a')
+        else:
+            self.file = open(self.path, 'w')
+            self.lines.append(json.dumps(self.header(folder, scale)))
+            self.sync()
+        self.written = time.monotonic()
+
+    def listed(self, folder, count, subfolders):
+        """
+            Records that the walk found count images and subfolders in
+            folder. A folder without images is finished straight away.
+        """
+        if self.file is None:
+            return
+        self.pending[folder] = [count, subfolders]
+        if count == 0:
+            self.finish_folder(folder)
+
+    def finished(self, path, row):
+        """
+            Records an image as finished with its catalog row, None if it
+            failed analysis, and its folder once it was the last one.
+            Images finished outside a scan, as in watch mode, are ignored.
+        """
+        if self.file is None:
+            return
+        if row is not None:
+            self.lines.append(json.dumps({'row': row}))
+        folder = os.path.dirname(path)
+        state = self.pending.get(folder)
+        if state is not None:
+            state[0] -= 1
+            if state[0] == 0:
+                self.finish_folder(folder)
+        if time.monotonic() - self.written >= self.interval:
+            self.sync()
+
+    def finish_folder(self, folder):
+        """
+            Records a folder whose images are all finished.
+        """
+        subfolders = self.pending.pop(folder)[1]
+        self.lines.append(json.dumps({'folder': folder, 'subfolders': subfolders}))
+
+    def sync(self):
+        """
+            Appends the buffered lines and flushes them to disk.
+        """
+        if self.file is None:
+            return
+        if self.lines:
+            self.file.write('\n'.join(self.lines) + '\n')
+            self.lines = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.written = time.monotonic()
+
+    def close(self):
+        """
+            Writes the buffered lines and closes the journal.
+        """
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        """
+            Deletes the journal once the scan is complete.
+        """
+        self.close()
+        self.lines = []
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
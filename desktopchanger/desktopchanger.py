@@ -1,7 +1,9 @@
 """
     The DesktopChanger class is the high level interface which enables the
     desktop background and panels (future) to be adjusted depending on the
-    time of day. The main public methods is the updater method.
+    time of day. The main public methods are the updater method, which
+    changes the wallpaper once, and the daemon method, which keeps running
+    and changes the wallpaper at each rotation or sunrise/sunset.
     The WallpaperChanger class sets a new wallpaper.
 
 TODO: Fill out info of the methods to call to perform specific tasks.
@@ -9,15 +11,20 @@ TODO: Fill out info of the methods to call to perform specific tasks.
     options.
 """
 
+import os
 import subprocess
 from pathlib import Path
 import logging
 import random
 import datetime
-import pytz
-import iso8601
-from desktopchanger.utils import CSVFileIO, YamlFileIO
-from desktopchanger.sunequation import SunEquation
+import time
+from desktopchanger.utils import YamlFileIO, SQLiteFileIO, is_night_image, \
+    open_catalog
+from desktopchanger.sunequation import SunEquation, SunTable
+from desktopchanger.backends import BackendError, SubprocessBackend, get_backend
+from desktopchanger import metrics
+from desktopchanger.shufflebag import ShuffleBag, path_id
+from desktopchanger.rendercache import RenderCache, parse_size
 
 ##### Functions
 #####
@@ -49,12 +56,48 @@ class DesktopChanger:
         yaml_config.read_yaml()
         try:
             self.csvfile = yaml_config.data['csvFile']
+            self.catalog = open_catalog(yaml_config.data)
             if yaml_config.data['latitude'] is None \
                 or yaml_config.data['longitude'] is None:
                 raise TypeError
             self.latitude = yaml_config.data['latitude']
             self.longitude = yaml_config.data['longitude']
+            # Seconds between wallpaper changes in daemon mode
+            self.rotation_interval = yaml_config.data.get('rotationInterval') or 60
             self.is_night_time = False
+            self.sunrise = self.sunset = self.timezone = None
+            self.sun_table = None
+            # Desktop backend, connected on the first wallpaper change
+            self.backend_name = yaml_config.data.get('backend') or 'auto'
+            self.backend = None
+            # Set every monitor and workspace rather than only the first
+            self.all_backdrops = bool(yaml_config.data.get('allBackdrops'))
+            self.backdrops = None
+            self.wallpapers = {}
+            # 'threshold' day/night split or 'nearest' feature vectors
+            self.selection = yaml_config.data.get('selection') or 'threshold'
+            if self.selection not in ('threshold', 'nearest'):
+                raise ValueError("selection must be 'threshold' or 'nearest'")
+            self.neighbours = yaml_config.data.get('neighbours') or 50
+            self.sun_equation = None
+            # Show every wallpaper of a bucket once before repeating
+            self.shuffle = bool(yaml_config.data.get('shuffleBag'))
+            self.bag_paths = {}
+            # while prefetching, bag ids are peeked at rather than taken
+            self.peeking = False
+            self.peeked = 0
+            # Wallpapers pre-scaled to the monitor, unset to use originals
+            self.render_cache = None
+            if yaml_config.data.get('renderSize'):
+                width, height = parse_size(yaml_config.data['renderSize'])
+                cache_mb = yaml_config.data.get('renderCacheMB') or 256
+                self.render_cache = RenderCache(width, height, cache_mb * 2**20)
+            self.prefetched = None
+            self.prefetch_executor = None
+            # Ask the selection service instead of reading the catalog
+            self.client = bool(getattr(args, 'client', False))
+            self.service_socket = yaml_config.data.get('serviceSocket') \
+                or os.path.join("data", "selection.sock")
         except TypeError as e_info:
             print("Latitude and/or longitude values must be filled in config.yaml. " + str(e_info))
             raise
@@ -66,98 +109,416 @@ class DesktopChanger:
             * get or compute sunset and sunrise times
             * set a randomised wallpaper depending on time of day
         """
-        self.update_sun()
+        with metrics.stage("update.sun"):
+            self.update_sun()
         if self.wallpaper_file is None:
-            wallpapers = self.load_csv()
-            self.select_wallpaper(wallpapers)
-        self.set_wallpaper()
+            if self.client:
+                with metrics.stage("update.request"):
+                    self.request_wallpapers()
+            elif self.queries_catalog():
+                with metrics.stage("update.choose"):
+                    self.choose_wallpapers(None)
+            else:
+                with metrics.stage("update.catalog"):
+                    wallpapers = self.load_wallpapers()
+                with metrics.stage("update.choose"):
+                    self.choose_wallpapers(wallpapers)
+        with metrics.stage("update.apply"):
+            self.set_wallpaper()
+        metrics.count("update.changes")
 
     def update_sun(self):
         """
-            Retrieve sun information from file or update the information if the
-            day (TODO: future location) information has changed.
+            Look today's sunrise and sunset up in the cached sun table of
+            this location. The table calculates and stores a whole year
+            when a new year, location or timezone is first seen.
 
             sets parameter is_night_time to True or False depending on the time of
             day.
         """
-        dates_yaml = YamlFileIO("data", "dates.yaml")
-        dates_yaml.read_yaml()
-        sunrise = sunset = timezone = None
-        if hasattr('dates_yaml', 'data'):
-            date = iso8601.parse_date(dates_yaml.data['date'])
-            if date == datetime.date.today():
-                # Parse from file if date hasn't changed
-                sunrise = iso8601.parse_date(dates_yaml.data['sunrise'])
-                sunset = iso8601.parse_date(dates_yaml.data['sunset'])
-                timezone = pytz.timezone(dates_yaml.data['timezone'])
-                #FUTURE: Can add location check here
-        if None in (sunrise, sunset, timezone):
-            # Otherwise create new times
-            sun_times = SunEquation(self.latitude, self.longitude)
-            sun_times.calculate()
-            date = datetime.date.today()
-            sunrise = sun_times.rise
-            sunset = sun_times.set
-            timezone = sun_times.timezone
-            output = sun_times.format_yaml()
-            dates_yaml.write_yaml(output)
-        current_time = datetime.datetime.now(timezone)
-        if  sunrise < current_time < sunset:
+        if self.sun_table is None:
+            self.sun_table = SunTable(self.latitude, self.longitude)
+        self.sunrise, self.sunset = self.sun_table.lookup(datetime.date.today())
+        self.timezone = self.sun_table.timezone
+        self.update_night_time()
+
+    def update_night_time(self):
+        """
+            Sets is_night_time from the stored sunrise and sunset times.
+        """
+        current_time = datetime.datetime.now(self.timezone)
+        if  self.sunrise < current_time < self.sunset:
             self.is_night_time = False
         else:
             self.is_night_time = True
 
+    def daemon(self):
+        """
+            Long running alternative to calling updater from cron every
+            minute. The catalog and sun times are kept in memory and the
+            process sleeps until the next event: the rotation interval,
+            sunrise, sunset or midnight when the sun times are renewed.
+            The csv catalog is read again when the file on disk changes,
+            a SQLite catalog is queried at each change instead.
+            With a render cache the wallpapers of the next change are
+            chosen and scaled in the background while the daemon sleeps.
+            As a client of the selection service the catalog is not read.
+            A change that fails, for example because the catalog is
+            missing or a bucket is empty, is logged and tried again at
+            the next event.
+        """
+        indexed = self.client or self.queries_catalog()
+        catalog_stamp = wallpapers = sun_date = stamp = None
+        while True:
+            with metrics.stage("update.sun"):
+                if sun_date != datetime.date.today():
+                    self.update_sun()
+                    sun_date = datetime.date.today()
+                else:
+                    self.update_night_time()
+            try:
+                if not self.client:
+                    stat = os.stat(self.catalog.path)
+                    stamp = (stat.st_mtime_ns, stat.st_size)
+                if not indexed and stamp != catalog_stamp:
+                    with metrics.stage("update.catalog"):
+                        wallpapers = self.load_wallpapers()
+                    catalog_stamp = stamp
+                if self.client:
+                    with metrics.stage("update.request"):
+                        self.request_wallpapers()
+                else:
+                    with metrics.stage("update.choose"):
+                        if not self.take_prefetched(stamp):
+                            self.choose_wallpapers(None if indexed else wallpapers)
+                with metrics.stage("update.apply"):
+                    self.set_wallpaper()
+                metrics.count("update.changes")
+                if self.render_cache is not None and not self.client:
+                    with metrics.stage("update.prefetch"):
+                        self.prefetch(None if indexed else wallpapers, stamp)
+            except (FileNotFoundError, ConnectionError, TimeoutError, ValueError,
+                    AssertionError, subprocess.CalledProcessError,
+                    BackendError) as e_info:
+                logging.warning("Wallpaper not changed: %s", repr(e_info))
+                metrics.count("update.failures")
+            delay = self.seconds_to_next_event()
+            logging.debug("Sleeping for %.1f seconds", delay)
+            time.sleep(delay)
+
+    def prefetch(self, wallpapers, stamp):
+        """
+            Chooses the wallpapers of the next change now and scales them
+            into the render cache in a background thread. stamp is the
+            catalog version they were chosen from. Shuffle bags are only
+            peeked at, and advanced once the prefetched wallpapers are
+            used, so a discarded prefetch skips no wallpaper. Nothing is
+            prefetched when a bag cycle ends before the next change.
+        """
+        self.peeking, self.peeked = True, 0
+        try:
+            self.choose_wallpapers(wallpapers)
+        finally:
+            self.peeking = False
+        if self.peeked is None:
+            return
+        chosen = dict(self.wallpapers)
+        if self.prefetch_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        future = self.prefetch_executor.submit(
+            lambda: [self.render_cache.get(path) for path in chosen.values()])
+        self.prefetched = (self.is_night_time, stamp, chosen, future, self.peeked)
+
+    def take_prefetched(self, stamp):
+        """
+            Uses the prefetched wallpapers if it is still night or day and
+            the catalog is unchanged, waiting for their scaling to finish.
+            The shuffle bag is then moved past the ids they used.
+            Returns False if they are out of date or there are none.
+        """
+        if self.prefetched is None:
+            return False
+        is_night_time, prefetched_stamp, chosen, future, peeked = self.prefetched
+        self.prefetched = None
+        if is_night_time != self.is_night_time or prefetched_stamp != stamp:
+            return False
+        future.result()
+        if peeked:
+            bag, bag_stamp = self.shuffle_bag()
+            bag.advance(bag_stamp, peeked)
+        self.wallpapers = chosen
+        return True
+
+    def seconds_to_next_event(self):
+        """
+            Returns the number of seconds until the wallpaper should next
+            be changed. This is the rotation interval unless sunrise,
+            sunset or midnight comes first.
+        """
+        current_time = datetime.datetime.now(self.timezone)
+        midnight = self.timezone.localize(datetime.datetime.combine(
+            current_time.date() + datetime.timedelta(days=1), datetime.time()))
+        delay = self.rotation_interval
+        for event in (self.sunrise, self.sunset, midnight):
+            # wake a second after a boundary so the new period is seen
+            seconds = (event - current_time).total_seconds() + 1
+            if 1 < seconds < delay:
+                delay = seconds
+        return delay
+
+    def queries_catalog(self):
+        """
+            True when each wallpaper is picked with a query on a SQLite
+            catalog rather than from the catalog loaded into memory.
+        """
+        return isinstance(self.catalog, SQLiteFileIO) and self.selection == 'threshold'
+
+    def load_wallpapers(self):
+        """
+            Returns the catalog loaded for the selection method: the
+            partitions of load_csv or the FeatureIndex of load_index.
+        """
+        if self.selection == 'nearest':
+            return self.load_index()
+        return self.load_csv()
+
+    def load_index(self):
+        """
+            Reads the catalog into a FeatureIndex for nearest neighbour
+            selection. numpy is only imported here. If no image has a
+            feature vector yet, the catalog is split into day and night
+            partitions instead until it is scanned again.
+        """
+        from desktopchanger.selection import FeatureIndex
+        data = self.catalog.read_rows()
+        index = FeatureIndex.from_rows(data, self.neighbours)
+        if not len(index):
+            logging.warning("No feature vectors in the catalog, using the day/night split")
+            return self.partition_wallpapers(data)
+        return index
+
     def load_csv(self):
         """
-            Reads in the csv file and loads the data into memory.
+            Reads in the catalog, without importing pandas, and returns
+            it split into night and day partitions.
         """
-        read_file = CSVFileIO(self.csvfile)
-        data = read_file.read_file()
+        data = self.catalog.read_rows()
         logging.debug("Number of lines read from csv file: %s", str(len(data)))
-        return data
+        self.bag_paths = {}
+        return self.partition_wallpapers(data)
+
+    def partition_wallpapers(self, images):
+        """
+            Splits the catalog rows into a dict of night (True) and day
+            (False) path lists using the night column stored at scan time.
+            Catalogs from before the column existed are classified here.
+            Done once per catalog load so that a pick is a random index.
+        """
+        partitions = {True: [], False: []}
+        for image in images:
+            night = image.get('night')
+            if night is None:
+                night = is_night_image(image['blue'], image['red'], image['light'])
+            partitions[bool(night)].append(image['path'])
+        try:
+            assert partitions[True]
+        except AssertionError as error:
+            print("No images left are processing criteria")
+            raise error
+        return partitions
 
-    def select_wallpaper(self, all_images):
+    def select_wallpaper(self, partitions):
         """
-            Selects the wallpaper to be set as desktop background.
+            Selects the wallpaper to be set as desktop background from
+            the partitions returned by load_csv, the next one from the
+            shuffle bag when shuffleBag is set in config.yaml.
         """
         # Search criterion reduces image list
-        filtered_paths = self.slice_wallpapers(all_images, self.is_night_time)
-        chosen_image = randomiser(len(filtered_paths))
-        self.wallpaper_file = Path(str(filtered_paths[chosen_image]))
+        filtered_paths = self.slice_wallpapers(partitions, self.is_night_time)
+        path = None
+        if self.shuffle:
+            path = self.bag_wallpaper(filtered_paths)
+        if path is None:
+            path = filtered_paths[randomiser(len(filtered_paths))]
+        self.wallpaper_file = Path(str(path))
         logging.debug("chosen image: %s", str(self.wallpaper_file))
 
-    def set_wallpaper(self):
+    def shuffle_bag(self):
         """
-            Updates the wallpaper by creating a WallpaperChanger object
-            and calling the apply_new_wallpaper method.
+            Returns the shuffle bag of the current night or day bucket and
+            the stamp of the catalog it should match.
         """
-        wallpaper_changer = WallpaperChanger(self.wallpaper_file)
-        wallpaper_changer.apply_new_wallpaper()
+        name = "shuffle_night.bag" if self.is_night_time else "shuffle_day.bag"
+        bag = ShuffleBag(os.path.join(os.getcwd(), "data", name))
+        stat = os.stat(self.catalog.path)
+        return bag, (stat.st_mtime_ns, stat.st_size)
 
-    def slice_wallpapers(self, images, is_night_time):
+    def bag_wallpaper(self, paths):
         """
-            Remove images not fitting the day/night criteria.
-            Currently the subset is day_pic + night_pic = images
+            Returns the next path of the shuffle bag of the current bucket,
+            whose ids are path hashes. The hash to path lookup of a bucket
+            is built once per catalog load. Returns None if the bag holds
+            no usable id.
+        """
+        lookup = self.bag_paths.get(self.is_night_time)
+        if lookup is None:
+            lookup = self.bag_paths[self.is_night_time] = {
+                path_id(path): path for path in paths}
+        bag, stamp = self.shuffle_bag()
+        return lookup.get(self.bag_next(bag, stamp, lookup.keys))
+
+    def bag_next(self, bag, stamp, ids):
         """
-        images = images.sort_values(['red', 'blue', 'light'])
+            Takes the next id of a shuffle bag. While prefetching the ids
+            are peeked at in turn instead, and self.peeked counts them or
+            is None once the cycle runs out.
+        """
+        if not self.peeking:
+            return bag.next(stamp, ids)
+        if self.peeked is None:
+            return None
+        value = bag.peek(stamp, ids, self.peeked)
+        self.peeked = None if value is None else self.peeked + 1
+        return value
+
+    def nearest_wallpaper(self, index):
+        """
+            Selects a wallpaper among the images of a FeatureIndex nearest
+            to the colour profile of the current daylight level, worked
+            out from the elevation of the sun.
+        """
+        if self.sun_equation is None:
+            self.sun_equation = SunEquation(self.latitude, self.longitude)
+        elevation = self.sun_equation.elevation(
+            datetime.datetime.now(datetime.timezone.utc))
+        daylight = SunEquation.daylight(elevation)
+        self.wallpaper_file = Path(index.select(daylight))
+        logging.debug("Daylight: %.2f, chosen image: %s", daylight, str(self.wallpaper_file))
+
+    def query_wallpaper(self):
+        """
+            Selects the wallpaper with indexed queries on a SQLite catalog
+            rather than loading every row. The random pick is the first
+            wallpaper of the bucket at or after a random rowid, so rowids
+            after a gap left by deleted rows are a little more likely.
+            With shuffleBag the bag holds the rowids of the bucket.
+        """
+        rowids = self.catalog.rowid_range(self.is_night_time)
         try:
-            night_images = images.loc[
-                (images.red < 0.15)
-                & (images.blue < 0.1)
-                & (images.light > 0.15)]
-            night_images_index = night_images.index.tolist()
-            assert night_images.empty is not True
+            assert rowids is not None
         except AssertionError as error:
             print("No images left are processing criteria")
             raise error
-        day_images_index = images.loc[
-                        ~images.index.isin(night_images_index)].index.tolist()
+        path = None
+        if self.shuffle:
+            bag, stamp = self.shuffle_bag()
+            rowid = self.bag_next(
+                bag, stamp, lambda: self.catalog.ids(self.is_night_time))
+            if rowid is not None:
+                path = self.catalog.path_of(rowid)
+        if path is None:
+            path = self.catalog.path_from(self.is_night_time, random.randint(*rowids))
+        if path is None:
+            # rows after the pick were deleted since, wrap around
+            path = self.catalog.path_from(self.is_night_time, rowids[0])
+        assert path is not None, "No images left are processing criteria"
+        self.wallpaper_file = Path(path)
+        logging.debug("chosen image: %s", str(self.wallpaper_file))
+
+    def choose_wallpapers(self, partitions):
+        """
+            Selects a wallpaper for every backdrop target. partitions is
+            the output of load_wallpapers, or None to query a SQLite
+            catalog.
+        """
+        self.wallpapers = {}
+        for target in self.backdrop_targets():
+            if partitions is None:
+                self.query_wallpaper()
+            elif isinstance(partitions, dict):
+                self.select_wallpaper(partitions)
+            else:
+                self.nearest_wallpaper(partitions)
+            self.wallpapers[target] = self.wallpaper_file
+
+    def request_wallpapers(self):
+        """
+            Asks the selection service for a wallpaper for every backdrop
+            target. The service also decides whether it is night.
+        """
+        from desktopchanger.service import request_wallpapers
+        response = request_wallpapers(self.service_socket, self.latitude,
+                                      self.longitude, self.backdrop_targets())
+        self.is_night_time = response['night']
+        self.wallpapers = {target: Path(path)
+                           for target, path in response['wallpapers'].items()}
+        logging.debug("Service wallpapers: %s", str(self.wallpapers))
+
+    def backdrop_targets(self):
+        """
+            Returns a dict of the backdrop properties to set and their
+            cached current values. With allBackdrops in config.yaml the
+            last-image property of every monitor and workspace is
+            discovered once and cached in data/backdrops.yaml, delete it
+            after changing monitors. Otherwise only the first workspace of
+            the first monitor is set and its value is read on every change.
+        """
+        if not self.all_backdrops:
+            return {WallpaperChanger.wallpaper_property: None}
+        if self.backdrops is None:
+            backdrops_yaml = YamlFileIO("data", "backdrops.yaml")
+            backdrops_yaml.read_yaml()
+            if backdrops_yaml.data:
+                self.backdrops = backdrops_yaml.data
+            else:
+                self.backdrops = WallpaperChanger.discover_backdrops(
+                    self.connect_backend())
+                backdrops_yaml.write_yaml(self.backdrops)
+            logging.debug("Backdrops: %s", str(list(self.backdrops)))
+        return self.backdrops
+
+    def connect_backend(self):
+        """
+            Returns the desktop backend, connecting on first use.
+        """
+        if self.backend is None:
+            self.backend = get_backend(self.backend_name)
+        return self.backend
+
+    def set_wallpaper(self):
+        """
+            Updates the wallpaper by creating a WallpaperChanger object
+            and calling the apply_new_wallpaper method. Every backdrop
+            target is set in one batch and the cached values are updated.
+            With a render cache the backdrops are pointed at the scaled
+            copies, made now if they were not prefetched.
+        """
+        targets = self.backdrop_targets()
+        wallpapers = self.wallpapers
+        if self.wallpaper_file is not None and not wallpapers:
+            wallpapers = {target: self.wallpaper_file for target in targets}
+        if self.render_cache is not None:
+            with metrics.stage("update.render"):
+                wallpapers = {target: Path(self.render_cache.get(path))
+                              for target, path in wallpapers.items()}
+        wallpaper_changer = WallpaperChanger(
+            wallpapers, self.connect_backend(), current=targets)
+        changes = wallpaper_changer.apply_new_wallpaper()
+        if self.all_backdrops and changes:
+            self.backdrops.update(changes)
+            YamlFileIO("data", "backdrops.yaml").write_yaml(self.backdrops)
+
+    def slice_wallpapers(self, partitions, is_night_time):
+        """
+            Returns the image paths fitting the day/night criteria.
+            Currently the subset is day_pic + night_pic = images
+        """
         if is_night_time:
-            logging.debug("Night images sliced: %i", len(night_images_index))
-            return night_images_index
+            logging.debug("Night images sliced: %i", len(partitions[True]))
         else:
-            logging.debug("Day images sliced: %i", len(day_images_index))
-            return day_images_index
+            logging.debug("Day images sliced: %i", len(partitions[False]))
+        return partitions[is_night_time]
 
     def set_theme(self):
         """
@@ -167,56 +528,75 @@ class DesktopChanger:
 
 class WallpaperChanger:
     """ The DesktopChanger class can be used to read and set the
-    wallpaper when provided with an image.
+    wallpaper when provided with an image. Settings are read and written
+    through a desktop backend, see backends.py.
     """
-    cmd_wallpaper_read = "xfconf-query --channel xfce4-desktop \
-        --property /backdrop/screen0/monitor0/workspace0/last-image"
-    cmd_wallpaper_set = "xfconf-query --channel xfce4-desktop \
-        --property /backdrop/screen0/monitor0/workspace0/last-image --set "
+    wallpaper_property = "/backdrop/screen0/monitor0/workspace0/last-image"
 
-    def __init__(self, wallpaper_file):
+    def __init__(self, wallpaper_file, backend=None, current=None):
         """
             Takes the new wallpaper_file selected. Then the current
-            wallpaper is read from xfconf-query.
-            * wallpaper_file should be a PosixPath object
+            wallpaper is read from the backend, by default xfconf-query.
+            * wallpaper_file should be a PosixPath object, or a dict of
+              backdrop property to PosixPath to set several backdrops
+            * current is an optional dict of cached backdrop values,
+              properties missing from it or set to None are read
         """
         try:
-            self.wallpaper = wallpaper_file
-            self.old_wallpaper = WallpaperChanger.current_wallpaper()
-            if not self.wallpaper.is_file():
-                raise FileNotFoundError
+            if isinstance(wallpaper_file, dict):
+                self.wallpapers = wallpaper_file
+            else:
+                self.wallpapers = {WallpaperChanger.wallpaper_property: wallpaper_file}
+            self.wallpaper = next(iter(self.wallpapers.values()))
+            self.backend = backend if backend is not None else SubprocessBackend()
+            current = current or {}
+            self.old_wallpapers = {}
+            for prop in self.wallpapers:
+                if current.get(prop) is not None:
+                    self.old_wallpapers[prop] = Path(current[prop])
+                else:
+                    self.old_wallpapers[prop] = Path(self.backend.read(prop))
+            self.old_wallpaper = self.old_wallpapers[next(iter(self.wallpapers))]
+            for wallpaper in self.wallpapers.values():
+                if not wallpaper.is_file():
+                    raise FileNotFoundError
         except FileNotFoundError:
             print("The wallpaper file doesn't exist. \n")
             raise
 
     @staticmethod
-    def current_wallpaper():
+    def current_wallpaper(backend=None):
         """
-            Read current wallpaper being applied from xfconf-query.
-            Returns a Path object stripped of bash wrapping.
+            Read current wallpaper being applied from the backend.
+            Returns a Path object.
         """
-        try:
-            output = subprocess.check_output(
-                WallpaperChanger.cmd_wallpaper_read, shell='/bin/bash')
-        except subprocess.CalledProcessError as e_info:
-            print("subprocess did not run successfully. " + str(e_info))
-            raise
-        return Path(output.strip().decode())
+        if backend is None:
+            backend = SubprocessBackend()
+        return Path(backend.read(WallpaperChanger.wallpaper_property))
+
+    @staticmethod
+    def discover_backdrops(backend):
+        """
+            Returns a dict of every monitor and workspace last-image
+            property and its current value.
+        """
+        properties = backend.list_properties("/backdrop")
+        return {prop: value for prop, value in sorted(properties.items())
+                if prop.endswith("/last-image")}
 
     def apply_new_wallpaper(self):
         """
-            Updates the wallpaper if the current new image is different to
-            the current image. Otherwise it does nothing.
+            Updates each backdrop whose current image is different to its
+            new image in one batched backend call. Otherwise it does
+            nothing. Returns a dict of the properties changed.
         """
-        try:
-            logging.debug("Old wallpaper is: %s", str(self.old_wallpaper))
-            logging.debug("New wallpaper is: %s", str(self.wallpaper))
-            if self.old_wallpaper != self.wallpaper:
-                cmd = (
-                    WallpaperChanger.cmd_wallpaper_set
-                    + repr(str(self.wallpaper)))
-                cmd_output = subprocess.run(cmd, shell='/bin/bash')
-                logging.debug(cmd_output)
-        except subprocess.CalledProcessError:
-            print("subprocess did not run successfully. ")
-            raise
+        logging.debug("Old wallpaper is: %s", str(self.old_wallpaper))
+        logging.debug("New wallpaper is: %s", str(self.wallpaper))
+        changes = {prop: str(wallpaper)
+                   for prop, wallpaper in self.wallpapers.items()
+                   if self.old_wallpapers[prop] != wallpaper}
+        if changes:
+            self.backend.write_many(changes)
+        logging.debug("Backdrops changed: %i of %i",
+                      len(changes), len(self.wallpapers))
+        return changes
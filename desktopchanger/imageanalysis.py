@@ -4,14 +4,170 @@
     Including:
         * hues
         * dark/light balance
+        * a hue/brightness feature vector, see selection.py
+    Images can be decoded at a reduced scale to save time and memory
+    on very large wallpapers, see Image for the accuracy trade-off.
+    Alternatively a memory cap analyses the image in strips with the
+    same results as a whole image analysis, as long as the decoded image
+    fits in the cap.
+    Files can be memory mapped and decoded from the mapping, see
+    imagereader.py.
 """
 
 import logging
+import struct
 import numpy as np
 import cv2
+from desktopchanger import metrics
+from desktopchanger.imagereader import map_image
+from desktopchanger.selection import FEATURE_HUE_BINS, FEATURE_VALUE_BINS
+
+# supported decode scales and their matching reduced imread flags
+DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# formats libjpeg can decode directly at a reduced scale
+SCALED_DECODE_FORMATS = {".jpg", ".jpeg"}
+# joint hsv histogram: a bin per hue, saturation split at 80, a bin per value
+HIST_SIZE = [180, 4, 256]
+HIST_RANGES = [0, 180, 0, 320, 0, 256]
+# float32 histogram bins count exactly up to this many pixels
+EXACT_PIXELS = 2 ** 24
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# JPEG start of frame markers, which hold the image size
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# end of image markers, the IEND chunk type and crc for PNG
+JPEG_END = b'\xff\xd9'
+PNG_END = b'IEND\xaeB`\x82'
+# bytes at the end of a file searched for the end of image marker,
+# room for metadata some cameras append after it
+TAIL_BYTES = 65536
+# rows of HSV strip a memory cap must leave room for beside the image
+MIN_STRIP_ROWS = 64
 
 ##### Functions
 #####
+def read_image_header(path, check_end=False):
+    """
+        Returns the format ('jpeg' or 'png'), width and height stored in
+        the header of a JPEG or PNG file, whatever its extension, or None
+        if the file is neither or its header is damaged. Only the header
+        is read, not the image data. With check_end the last TAIL_BYTES
+        of the file must also hold the end of image marker, which a
+        truncated file lacks.
+    """
+    with open(path, 'rb') as f:
+        header = read_header(f)
+        if header is None or not check_end:
+            return header
+        f.seek(0, 2)
+        f.seek(max(0, f.tell() - TAIL_BYTES))
+        end = PNG_END if header[0] == 'png' else JPEG_END
+        if end not in f.read():
+            return None
+        return header
+
+def read_header(f):
+    """
+        Parses the header of the open file f for read_image_header.
+    """
+    start = f.read(8)
+    if start == PNG_SIGNATURE:
+        chunk = f.read(16)
+        if len(chunk) < 16 or chunk[4:8] != b'IHDR':
+            return None
+        return ('png',) + struct.unpack('>II', chunk[8:16])
+    if start[:2] != b'\xff\xd8':
+        return None
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if byte != b'\xff':
+            return None
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # markers without a length
+            continue
+        length = f.read(2)
+        if len(length) < 2 or marker == 0xDA:
+            # end of file or image data before any frame header
+            return None
+        length = struct.unpack('>H', length)[0]
+        if marker in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return 'jpeg', width, height
+        f.seek(length - 2, 1)
+
+def fitting_scale(path, scale, max_bytes):
+    """
+        Returns the smallest decode scale from scale up whose decoded
+        image and MIN_STRIP_ROWS rows of HSV strip fit in max_bytes.
+        Formats other than JPEG are decoded in full before they are
+        shrunk, so the full image and the shrunk copy must fit as well.
+        scale is returned unchanged if the header cannot be read.
+        Raises ValueError if no scale fits.
+    """
+    header = read_image_header(path)
+    if header is None or 0 in header[1:]:
+        return scale
+    image_format, width, height = header
+    scaled = image_format == 'jpeg' and path.lower().endswith(tuple(SCALED_DECODE_FORMATS))
+    for candidate in sorted(DECODE_FLAGS):
+        if candidate < scale:
+            continue
+        row = -(-width // candidate) * 3
+        rows = -(-height // candidate)
+        needed = row * (rows + min(rows, MIN_STRIP_ROWS))
+        if candidate > 1 and not scaled:
+            needed = max(needed, width * height * 3 + row * rows)
+        if needed <= max_bytes:
+            return candidate
+    raise ValueError("{0}x{1} image does not fit in {2:.1f} MB of analysis memory"
+                     .format(width, height, max_bytes / 2**20))
+
+def sniff_image(path, min_size=(0, 0)):
+    """
+        Pre-filter run before an image is decoded. Returns the (width,
+        height) of the image from its header, or None for a file that is
+        not a JPEG or PNG, is damaged or truncated, or is smaller than
+        min_size. min_size is (width, height) and either orientation
+        passes: the long side is held to the larger number and the short
+        side to the smaller.
+    """
+    try:
+        header = read_image_header(path, check_end=True)
+    except OSError as e_info:
+        logging.warning("Could not read image header %s: %s", path, repr(e_info))
+        return None
+    if header is None or 0 in header[1:]:
+        logging.warning("Skipping damaged or unknown image %s", path)
+        return None
+    size = header[1:]
+    if not large_enough(size, min_size):
+        logging.debug("Skipping image %s, %ix%i is below the minimum size",
+                      path, size[0], size[1])
+        return None
+    return size
+
+def large_enough(size, min_size):
+    """
+        True if an image of size (width, height) is at least min_size in
+        either orientation.
+    """
+    short, long = sorted(size)
+    min_short, min_long = sorted(min_size)
+    return short >= min_short and long >= min_long
 
 ##### Classes
 #####
@@ -22,80 +178,248 @@ class ImageAnalysis:
             * reading the important hsv values
     """
 
-    def __init__(self, path):
+    def __init__(self, path, scale=1, max_bytes=None, mapped=False):
         """
             Reads in the image path and set up an image.
+            scale is the decode reduction factor, max_bytes the working
+            memory cap and mapped turns on memory mapped reads, all
+            passed on to Image.
         """
         logging.debug("Image Analysis: Analyse path: %s", path)
-        self.image = Image(path)
+        self.image = Image(path, scale, max_bytes, mapped)
 
     def analyse_hsv(self):
         """
             Convert the RGB image to HSV and return the red, green, blue/
             colours and dark/light balance of the image.
         """
-        self.image.convert_hsv()
-        blue, green, red = self.image.primary_hues()
-        light, dark = self.image.value_gradient()
+        with metrics.stage("analysis.convert_hsv"):
+            self.image.convert_hsv()
+        with metrics.stage("analysis.histogram"):
+            self.image.histogram()
+        with metrics.stage("analysis.fractions"):
+            blue, green, red = self.image.primary_hues()
+            light, dark = self.image.value_gradient()
         logging.debug("HSV values: \n red: {0:.5f}, \
             blue: {1:.5f}, green: {2:.5f}  \
             \n light: {3:.5f}, dark: {4:.5f} \
             ".format(blue, green, red, light, dark))
         return blue, green, red, light, dark
 
+    def analyse_features(self):
+        """
+            Returns the float16 hue/brightness feature vector of the
+            image. Reuses the histogram of analyse_hsv when it was called
+            first.
+        """
+        if self.image.hist is None:
+            self.image.convert_hsv()
+        with metrics.stage("analysis.features"):
+            return self.image.features()
+
 class Image:
     """
         Represents a single image.
+
+        The image can be decoded at 1/2, 1/4 or 1/8 of its width and
+        height. JPEG files use the scaled decode of libjpeg, other
+        formats are decoded in full and shrunk with an area resize.
+
+        Accuracy bound: each reduced pixel is (close to) the mean of an
+        s x s block of full resolution pixels. A block whose pixels all
+        fall on the same side of every hue/saturation/value threshold
+        gives the same answer as at full resolution, so only blocks that
+        straddle a threshold can change class. The drift of any fraction
+        is therefore at most the fraction of such mixed blocks, plus
+        (height + width) * s / (height * width) for the partial blocks
+        dropped at the right and bottom edges. Large flat areas, typical
+        of wallpapers, give drifts well under 0.01 at scale 4 while
+        noisy images with many colour edges drift the most.
+
+        Tiled mode: with max_bytes set the full size HSV copy is never
+        made. convert_hsv is skipped and histogram converts one strip of
+        rows at a time, each strip's HSV buffer holding what the decoded
+        image leaves of max_bytes. The conversion is per pixel, so the
+        counts and every result are identical to the whole image path.
+        Peak memory is then the decoded image plus one strip instead of
+        twice the decoded image. An image too large to fit in max_bytes
+        with MIN_STRIP_ROWS rows of strip is decoded at the smallest
+        reduced scale that fits, see fitting_scale, with the accuracy
+        trade-off above, and is rejected if none does.
+
+        Mapped reads: the file is memory mapped and decoded with
+        cv2.imdecode from the mapping rather than read by cv2.imread.
+        imdecode cannot decode into a given array, so tiled mode keeps
+        its header sized imread decode.
     """
-    def __init__(self, path):
+    # working memory cap in bytes for tiled mode, None for whole image
+    max_bytes = None
+
+    def __init__(self, path, scale=1, max_bytes=None, mapped=False):
         """
             Read in the file path and load the file as an opencv numpy.
+            scale is the decode reduction factor, one of DECODE_FLAGS.
+            max_bytes turns on tiled mode with this memory cap for the
+            decoded image and its strips, raising scale if needed.
+            mapped decodes from a memory mapping of the file.
         """
         try:
-            self.img = cv2.imread(path)
+            if scale not in DECODE_FLAGS:
+                raise ValueError("Decode scale must be one of "
+                                 + str(sorted(DECODE_FLAGS)))
+            if max_bytes:
+                fitted = fitting_scale(path, scale, max_bytes)
+                if fitted != scale:
+                    logging.debug("Decoding %s at 1/%i to fit the analysis memory",
+                                  path, fitted)
+                scale = fitted
+            self.scale = scale
+            with metrics.stage("analysis.decode"):
+                if max_bytes and (scale == 1 or path.lower().endswith(
+                        tuple(SCALED_DECODE_FORMATS))):
+                    self.img = Image.decode_whole(path, scale, max_bytes)
+                else:
+                    self.img = Image.decode(path, scale, mapped)
             self.hsv = []
+            self.hist = None
+            self.max_bytes = max_bytes
             if self.img is None:
                 raise FileNotFoundError
         except FileNotFoundError:
             print("Could not load image. \n")
             raise
 
+    @staticmethod
+    def read(path, flags, mapped=False):
+        """
+            Decode the image file with imread flags, from a memory mapping
+            of the file if mapped. Returns None if the file could not be
+            decoded.
+        """
+        if mapped:
+            return cv2.imdecode(map_image(path), flags)
+        return cv2.imread(path, flags)
+
+    @staticmethod
+    def decode(path, scale, mapped=False):
+        """
+            Decode the image file reduced by scale in both dimensions.
+            Returns None if the file could not be decoded.
+        """
+        if scale == 1:
+            return Image.read(path, cv2.IMREAD_COLOR, mapped)
+        if path.lower().endswith(tuple(SCALED_DECODE_FORMATS)):
+            return Image.read(path, DECODE_FLAGS[scale], mapped)
+        img = Image.read(path, cv2.IMREAD_COLOR, mapped)
+        if img is None:
+            return None
+        height, width, _ = img.shape
+        size = (max(1, width // scale), max(1, height // scale))
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def decode_whole(path, scale=1, max_bytes=None):
+        """
+            Decode for tiled mode, at full size or a JPEG scaled decode.
+            opencv's imread holds a second buffer of the decoded size while
+            it decodes. Decoding into an array sized from the file header
+            avoids it and halves the peak memory. imread is used when the
+            header cannot be read or this opencv cannot decode into an
+            array.
+            imread returns None for a failed decode, but some opencv
+            versions return the untouched array instead. An array still
+            all zero is a failed decode or a black image. For JPEG a
+            decode at an eighth of the size tells the two apart and the
+            zero array is kept. Other formats have no cheap check and are
+            decoded again with plain imread, which holds the second
+            buffer, so with max_bytes too small for that the image is
+            rejected with ValueError.
+        """
+        flags = DECODE_FLAGS[scale]
+        header = read_image_header(path)
+        if header is None or 0 in header[1:]:
+            return cv2.imread(path, flags)
+        # libjpeg rounds scaled sizes up
+        width, height = (-(-length // scale) for length in header[1:])
+        img = np.zeros((height, width, 3), np.uint8)
+        try:
+            img = cv2.imread(path, img, flags)
+        except (TypeError, cv2.error):
+            # no imread into an array, or rotated by its exif orientation
+            return cv2.imread(path, flags)
+        if img is None or img.any():
+            return img
+        if header[0] == 'jpeg':
+            if cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_8) is None:
+                return None
+            return img
+        if max_bytes and 2 * img.nbytes > max_bytes:
+            raise ValueError("A black {0}x{1} image cannot be told from a damaged one "
+                             "in {2:.1f} MB of analysis memory".format(
+                                 width, height, max_bytes / 2**20))
+        # free the array before decoding again
+        img = None
+        return cv2.imread(path, flags)
+
     def convert_hsv(self):
         """
-            Converts the rgb self.img into the HSV scheme
+            Converts the rgb self.img into the HSV scheme. In tiled mode
+            the conversion is left to histogram, strip by strip.
         """
+        self.hist = None
+        if self.max_bytes:
+            self.hsv = []
+            return
         self.hsv = cv2.cvtColor(self.img, cv2.COLOR_BGR2HSV)
 
+    def histogram(self):
+        """
+            Returns the joint hue/saturation/value histogram of self.hsv,
+            built in a single pass and cached until the next convert_hsv.
+            Hue and value keep one bin per level while saturation is split
+            into bins of 80 so that every threshold used by primary_hues
+            and value_gradient falls on a bin edge and the counts are
+            exact. The image is histogrammed in strips of at most
+            EXACT_PIXELS pixels because opencv returns float32 bins.
+            In tiled mode each strip is also small enough for its HSV
+            conversion to fit in what the decoded image leaves of
+            max_bytes, and is converted just before it is counted.
+        """
+        if self.hist is None:
+            height, width, _ = self.img.shape
+            rows = max(1, EXACT_PIXELS // width)
+            if self.max_bytes:
+                rows = max(1, min(rows, (self.max_bytes - self.img.nbytes) // (width * 3)))
+            self.hist = np.zeros(HIST_SIZE, np.int64)
+            if self.max_bytes:
+                # one strip buffer reused, so two strips are never held
+                buffer = np.empty((min(rows, height), width, 3), np.uint8)
+            for top in range(0, height, rows):
+                if self.max_bytes:
+                    strip = buffer[:min(rows, height - top)]
+                    cv2.cvtColor(self.img[top:top+rows], cv2.COLOR_BGR2HSV, dst=strip)
+                else:
+                    strip = self.hsv[top:top+rows]
+                self.hist += cv2.calcHist(
+                    [strip], [0, 1, 2], None, HIST_SIZE, HIST_RANGES
+                    ).astype(np.int64)
+        return self.hist
+
     def primary_hues(self):
         """
             Returns the fraction of primary colours represented in the image.
             Note this number won't necessarily add to 1.
-            Takes in the hue channel information and returns
-            red, green, blue fracions
-        """
-        # lower and upper bound blue
-        lower_blue = np.array([104, 80, 80])
-        upper_blue = np.array([134, 255, 255])
-        blue_hsv = cv2.inRange(self.hsv, lower_blue, upper_blue)
-
-        # lower and upper bound green
-        lower_green = np.array([44, 80, 80])
-        upper_green = np.array([74, 255, 255])
-        green_hsv = cv2.inRange(self.hsv, lower_green, upper_green)
-
-        # lower and upper bound red on the low value hsv half-circle
-        lower_red_low = np.array([0, 80, 80])
-        upper_red_low = np.array([14, 255, 255])
-        # lower and upper bound red on the high value hsv half-circle
-        lower_red_high = np.array([164, 80, 80])
-        upper_red_high = np.array([179, 255, 255])
-        red_hsv_low = cv2.inRange(self.hsv, lower_red_low, upper_red_low)
-        red_hsv_high = cv2.inRange(self.hsv, lower_red_high, upper_red_high)
-        red_hsv = cv2.bitwise_or(red_hsv_low, red_hsv_high)
-
-        blue = cv2.countNonZero(blue_hsv)
-        green = cv2.countNonZero(green_hsv)
-        red = cv2.countNonZero(red_hsv)
+            Counts pixels with saturation and value of at least 80 in the
+            hue ranges below and returns red, green, blue fracions.
+                * blue: 104 - 134
+                * green: 44 - 74
+                * red: 0 - 14 and 164 - 179
+        """
+        # per hue counts of pixels with saturation and value >= 80
+        hues = self.histogram()[:, 1:, 80:].sum(axis=(1, 2))
+        blue = int(hues[104:135].sum())
+        green = int(hues[44:75].sum())
+        red = int(hues[0:15].sum() + hues[164:180].sum())
         height, width, _ = self.img.shape
         size = height*width
         return blue/size, green/size, red/size
@@ -108,19 +432,25 @@ class Image:
             third of the value gradient.
             Returns light, dark fractional values
         """
-
-        # lower and upper bound brightnesss
-        lower_blue = np.array([0, 0, 170])
-        upper_blue = np.array([255, 255, 255])
-        light_hsv = cv2.inRange(self.hsv, lower_blue, upper_blue)
-
-        # lower and upper bound darkness
-        lower_blue = np.array([0, 0, 0])
-        upper_blue = np.array([255, 255, 80])
-        dark_hsv = cv2.inRange(self.hsv, lower_blue, upper_blue)
-
-        light = cv2.countNonZero(light_hsv)
-        dark = cv2.countNonZero(dark_hsv)
+        values = self.histogram().sum(axis=(0, 1))
+        # brightness 170 and over
+        light = int(values[170:].sum())
+        # darkness 80 and under
+        dark = int(values[:81].sum())
         height, width, _ = self.img.shape
         size = height*width
         return light/size, dark/size
+
+    def features(self):
+        """
+            Returns the feature vector of the image as float16: the
+            fraction of pixels with saturation and value of at least 80 in
+            each of FEATURE_HUE_BINS equal hue bins, then the fraction of
+            pixels in each of FEATURE_VALUE_BINS equal value bins.
+        """
+        hist = self.histogram()
+        hues = hist[:, 1:, 80:].sum(axis=(1, 2)).reshape(FEATURE_HUE_BINS, -1).sum(axis=1)
+        values = hist.sum(axis=(0, 1)).reshape(FEATURE_VALUE_BINS, -1).sum(axis=1)
+        height, width, _ = self.img.shape
+        size = height*width
+        return (np.concatenate([hues, values]) / size).astype(np.float16)
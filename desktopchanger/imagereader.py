@@ -0,0 +1,111 @@
+"""
+    Image file reading for the scanner.
+    map_image memory maps a file and returns a numpy view of its bytes
+    for cv2.imdecode, so the file is decoded straight from the page
+    cache without being copied into a Python buffer first.
+    readahead wraps the stream of files found by the folder walk and
+    reads the next few files in background threads while the current
+    one is decoded. Each file is read in large sequential blocks, which
+    pulls it into the page cache even on network file systems such as
+    NFS where the kernel's own read-ahead is limited, so that decoding
+    rarely waits for the disk or the network.
+"""
+
+import os
+import mmap
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from desktopchanger import metrics
+
+# size of each sequential read made by the read-ahead threads
+READ_BLOCK = 4 * 2**20
+# read-ahead threads, files on network storage are read in parallel
+READ_THREADS = 4
+
+##### Functions
+#####
+def map_image(path):
+    """
+        Returns a read only uint8 array over the memory mapped contents
+        of the file at path. The mapping is released once the array is
+        no longer referenced. Raises ValueError for an empty file.
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return np.frombuffer(mapped, np.uint8)
+
+def prefetch(path, block):
+    """
+        Reads the whole file at path into the page cache with large
+        sequential reads into block, a reused bytearray. Returns the
+        number of bytes read. Errors are left for the decode to report.
+    """
+    read = 0
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            view = memoryview(block)
+            while True:
+                count = f.readinto(view)
+                if not count:
+                    break
+                read += count
+    except OSError as e_info:
+        logging.debug("Read-ahead skipped %s: %s", path, repr(e_info))
+    return read
+
+def readahead(image_files, depth, needed=None):
+    """
+        Yields the (path, stat) pairs of image_files unchanged while the
+        files of the next depth pairs are read into the page cache in
+        background threads. depth 0 yields the pairs with no read-ahead.
+        needed, if given, is called with each pair and files it returns
+        False for are not read, such as images an incremental scan reuses.
+        Files whose read finished before they were yielded are counted
+        as scan.readahead_ready, the others as scan.readahead_late.
+    """
+    if depth < 1:
+        yield from image_files
+        return
+    threads = min(depth, READ_THREADS)
+    # one read buffer per thread, handed out as the reads start
+    blocks = deque(bytearray(READ_BLOCK) for _ in range(threads))
+
+    def read(path):
+        block = blocks.popleft()
+        try:
+            return prefetch(path, block)
+        finally:
+            blocks.append(block)
+
+    queue = deque()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        try:
+            for item in image_files:
+                future = None
+                if needed is None or needed(item):
+                    future = executor.submit(read, item[0])
+                queue.append((item, future))
+                if len(queue) > depth:
+                    yield take(queue)
+            while queue:
+                yield take(queue)
+        finally:
+            for _, future in queue:
+                if future is not None:
+                    future.cancel()
+
+def take(queue):
+    """
+        Pops the oldest (item, future) pair of a readahead queue and
+        returns the item.
+    """
+    item, future = queue.popleft()
+    if future is not None:
+        metrics.count("scan.readahead_ready" if future.done() else "scan.readahead_late")
+    return item
@@ -0,0 +1,259 @@
+"""
+    Low overhead timing of each stage of the scan and the wallpaper
+    update. A stage is timed with a context manager:
+
+        with metrics.stage("analysis.decode"):
+            ...
+
+    Every stage keeps a call counter, the total time and a latency
+    histogram. Plain counters (images reused, images failed, ...) are
+    added with metrics.count. The collected metrics can be dumped as json
+    or in the Prometheus text format.
+    When profiling is switched on each stage also runs under its own
+    cProfile profiler. Nested stages pause the profiler of the enclosing
+    stage so each profile only holds the time spent in its own stage.
+    Stages run in background threads are timed but not profiled.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+# prefix of the metric names in the Prometheus text format
+PROMETHEUS_PREFIX = "desktopchanger_"
+
+##### Functions
+#####
+def stage(name):
+    """
+        Times a with block as stage name in the process registry.
+    """
+    return METRICS.stage(name)
+
+def count(name, value=1):
+    """
+        Adds value to counter name in the process registry.
+    """
+    METRICS.count(name, value)
+
+##### Classes
+#####
+class Metrics:
+    """
+        Registry of the counters and stage timings of one process.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.stages = {}
+        self.profilers = None
+        self.active = []
+        # profile statistics merged in from worker processes
+        self.merged_profiles = {}
+
+    def enable_profiling(self):
+        """
+            Runs every stage from now on under a cProfile profiler.
+        """
+        if self.profilers is None:
+            self.profilers = {}
+
+    def count(self, name, value=1):
+        """
+            Adds value to the counter name.
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """
+            Records one run of stage name which took seconds.
+        """
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {
+                'count': 0, 'sum': 0.0, 'buckets': [0] * (len(BUCKETS) + 1)}
+        stage['count'] += 1
+        stage['sum'] += seconds
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        stage['buckets'][index] += 1
+
+    @contextmanager
+    def stage(self, name):
+        """
+            Times the code run inside the with block as stage name.
+        """
+        profiler = None
+        if self.profilers is not None \
+            and threading.current_thread() is threading.main_thread():
+            profiler = self.start_profiler(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+            if profiler is not None:
+                self.stop_profiler(profiler)
+
+    def start_profiler(self, name):
+        """
+            Pauses the profiler of the enclosing stage and starts the one
+            of stage name.
+        """
+        profiler = self.profilers.get(name)
+        if profiler is None:
+            import cProfile
+            profiler = self.profilers[name] = cProfile.Profile()
+        if self.active:
+            self.active[-1].disable()
+        self.active.append(profiler)
+        profiler.enable()
+        return profiler
+
+    def stop_profiler(self, profiler):
+        """
+            Stops the profiler of a stage and resumes the one of the
+            enclosing stage.
+        """
+        profiler.disable()
+        self.active.pop()
+        if self.active:
+            self.active[-1].enable()
+
+    def merge(self, snapshot):
+        """
+            Adds a snapshot taken with pop, for example in a worker
+            process, to this registry.
+        """
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+        for name, other in snapshot['stages'].items():
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = {'count': other['count'], 'sum': other['sum'],
+                                     'buckets': list(other['buckets'])}
+                continue
+            stage['count'] += other['count']
+            stage['sum'] += other['sum']
+            stage['buckets'] = [a + b for a, b in zip(stage['buckets'], other['buckets'])]
+        for name, stats in snapshot.get('profiles', {}).items():
+            self.merged_profiles.setdefault(name, []).append(ProfileStats(stats))
+
+    def pop(self):
+        """
+            Returns a snapshot of the counters and stages and clears them.
+            When profiling, the statistics of each finished stage profiler
+            are included and the profilers are started afresh.
+        """
+        snapshot = self.to_dict()
+        self.counters = {}
+        self.stages = {}
+        if self.profilers and not self.active:
+            snapshot['profiles'] = {}
+            for name, profiler in self.profilers.items():
+                profiler.create_stats()
+                snapshot['profiles'][name] = profiler.stats
+            self.profilers = {}
+        return snapshot
+
+    def to_dict(self):
+        """
+            Returns the counters and stage timings as a dict.
+        """
+        return {'counters': dict(self.counters),
+                'stages': {name: dict(stage, buckets=list(stage['buckets']))
+                           for name, stage in self.stages.items()}}
+
+    def to_json(self):
+        """
+            Returns the metrics as a json string with the bucket bounds.
+        """
+        output = self.to_dict()
+        output['buckets'] = BUCKETS
+        return json.dumps(output, indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+            Returns the metrics in the Prometheus text exposition format.
+            Stages become one histogram, labelled by stage, and each
+            counter becomes a counter of its own.
+        """
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            metric = PROMETHEUS_PREFIX + name.replace('.', '_') + "_total"
+            lines.append("# TYPE {0} counter".format(metric))
+            lines.append("{0} {1}".format(metric, value))
+        metric = PROMETHEUS_PREFIX + "stage_seconds"
+        lines.append("# TYPE {0} histogram".format(metric))
+        for name, stage in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, calls in zip(BUCKETS + ['+Inf'], stage['buckets']):
+                cumulative += calls
+                lines.append('{0}_bucket{{stage="{1}",le="{2}"}} {3}'.format(
+                    metric, name, bound, cumulative))
+            lines.append('{0}_sum{{stage="{1}"}} {2}'.format(metric, name, stage['sum']))
+            lines.append('{0}_count{{stage="{1}"}} {2}'.format(metric, name, stage['count']))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """
+            Writes the metrics to path, in the Prometheus text format when
+            the file name ends in .prom and as json otherwise.
+        """
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = self.to_json()
+        with open(path, 'w') as f:
+            f.write(text)
+        logging.debug("Metrics written to: %s", path)
+
+    def dump_profiles(self, folder):
+        """
+            Writes the cProfile statistics of each stage, including those
+            merged from worker processes, to folder/<stage>.prof, readable
+            with pstats or snakeviz.
+        """
+        if self.profilers is None:
+            return
+        import pstats
+        os.makedirs(folder, exist_ok=True)
+        for name in set(self.profilers) | set(self.merged_profiles):
+            profiles = list(self.merged_profiles.get(name, []))
+            if name in self.profilers:
+                profiles.append(self.profilers[name])
+            pstats.Stats(*profiles).dump_stats(os.path.join(folder, name + ".prof"))
+        logging.debug("Stage profiles written to: %s", folder)
+
+    def summary(self):
+        """
+            Returns one line per stage with its calls, total and mean time.
+        """
+        lines = []
+        for name, stage in sorted(self.stages.items()):
+            lines.append("{0:28} {1:8} calls {2:10.3f} s {3:10.3f} ms/call".format(
+                name, stage['count'], stage['sum'], 1000 * stage['sum'] / stage['count']))
+        for name, value in sorted(self.counters.items()):
+            lines.append("{0:28} {1:8}".format(name, value))
+        return "\n".join(lines)
+
+class ProfileStats:
+    """
+        Profile statistics received from another process, in the form
+        pstats.Stats accepts in place of a profiler.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        """
+            The statistics are already complete.
+        """
+
+# registry of this process, shared by every module
+METRICS = Metrics()
@@ -0,0 +1,145 @@
+"""
+    Render cache of wallpapers pre-scaled to the monitor resolution.
+    xfdesktop is handed a small local copy instead of the original, which
+    may be a very large file on network storage that stalls the desktop
+    while it is decoded and scaled.
+    Copies are shrunk, keeping their aspect ratio, until they just cover
+    the monitor, and are never enlarged. They are kept in data/render
+    under a hash of the original path, size, modification time and the
+    monitor size, so a changed original gets a new copy. The cache is
+    bounded in size and the least recently used copies are removed first.
+    opencv is only imported when a copy is made.
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+from desktopchanger import metrics
+
+##### Functions
+#####
+def parse_size(size, name='renderSize'):
+    """
+        Returns (width, height) from a 'WIDTHxHEIGHT' string. name is the
+        config.yaml key it came from, for the error message.
+    """
+    try:
+        width, height = (int(value) for value in str(size).lower().split('x'))
+        if width < 1 or height < 1:
+            raise ValueError
+    except ValueError:
+        print(name + " must be written as WIDTHxHEIGHT, e.g. 1920x1080 \n")
+        raise
+    return width, height
+
+##### Classes
+#####
+class RenderCache:
+    """
+        Size bounded LRU cache of pre-scaled wallpapers.
+    """
+    def __init__(self, width, height, max_bytes, folder=None):
+        self.width = width
+        self.height = height
+        self.max_bytes = max_bytes
+        if folder is None:
+            folder = os.path.join(os.getcwd(), "data", "render")
+        self.folder = folder
+        os.makedirs(self.folder, exist_ok=True)
+
+    def cache_path(self, path):
+        """
+            Returns the path of the cached copy of the original at path.
+        """
+        stat = os.stat(path)
+        key = "{0}|{1}|{2}|{3}x{4}".format(
+            os.path.abspath(path), stat.st_size, stat.st_mtime_ns, self.width, self.height)
+        digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        extension = os.path.splitext(str(path))[1].lower() or ".jpg"
+        return os.path.join(self.folder, digest + extension)
+
+    def get(self, path):
+        """
+            Returns the path of the pre-scaled copy of the wallpaper at
+            path, making it first if needed. The original path is returned
+            if the copy could not be made.
+        """
+        path = str(path)
+        try:
+            cached = self.cache_path(path)
+        except OSError as e_info:
+            logging.warning("Render cache skipped %s: %s", path, repr(e_info))
+            return path
+        try:
+            # mark as recently used for the LRU eviction
+            os.utime(cached)
+            metrics.count("render.hits")
+            return cached
+        except OSError:
+            # not made yet, or just evicted by another thread
+            pass
+        metrics.count("render.misses")
+        try:
+            with metrics.stage("render.scale"):
+                self.render(path, cached)
+        except (OSError, ValueError) as e_info:
+            logging.warning("Render cache could not scale %s: %s", path, repr(e_info))
+            return path
+        self.evict(keep={cached})
+        return cached
+
+    def render(self, path, cached):
+        """
+            Writes the copy of the image at path to cached, shrunk to just
+            cover width x height. Images already small enough are copied.
+            The image is read in colour, which turns it upright by its
+            exif orientation, as the written copy has no exif data.
+        """
+        import cv2
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("could not decode image")
+        height, width = img.shape[:2]
+        scale = max(self.width / width, self.height / height)
+        temp_path = cached + ".tmp" + os.path.splitext(cached)[1]
+        if scale >= 1:
+            shutil.copyfile(path, temp_path)
+        else:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+            params = []
+            if cached.endswith((".jpg", ".jpeg")):
+                params = [cv2.IMWRITE_JPEG_QUALITY, 95]
+            if not cv2.imwrite(temp_path, img, params):
+                raise ValueError("could not write " + temp_path)
+        os.replace(temp_path, cached)
+        logging.debug("Rendered %s to %s", path, cached)
+
+    def evict(self, keep=()):
+        """
+            Removes the least recently used copies until the cache fits in
+            max_bytes. Copies in keep are never removed.
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.folder) as files:
+            for entry in files:
+                # copies being written by another thread are left alone
+                if entry.is_file() and ".tmp" not in entry.name:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                    total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            metrics.count("render.evictions")
+            logging.debug("Render cache evicted %s", path)
@@ -0,0 +1,139 @@
+"""
+    Nearest neighbour wallpaper selection on the colour feature vectors
+    stored in the catalog.
+    Each image is described by FEATURE_BINS float16 values: the fraction
+    of saturated pixels in each of FEATURE_HUE_BINS hue bins followed by
+    the fraction of pixels in each of FEATURE_VALUE_BINS brightness bins.
+    The time of day is turned into a target vector between a night and a
+    day profile, and a wallpaper is drawn from the k images nearest to it.
+    The k nearest images of each quantised daylight level are worked out
+    once per catalog load, so a selection is a random pick from a small
+    precomputed list whatever the size of the catalog.
+"""
+
+import logging
+import random
+import numpy as np
+
+# hue bins of 15 hue levels (30 degrees) each, opencv hue runs 0 to 179
+FEATURE_HUE_BINS = 12
+# brightness bins of 16 value levels each
+FEATURE_VALUE_BINS = 16
+FEATURE_BINS = FEATURE_HUE_BINS + FEATURE_VALUE_BINS
+# daylight levels between full night (0) and full day
+DAYLIGHT_LEVELS = 20
+
+##### Functions
+#####
+def encode_features(features):
+    """
+        Returns a feature vector as the hex string of its little endian
+        float16 values, the form stored in the catalog.
+    """
+    return np.asarray(features, '<f2').tobytes().hex()
+
+def decode_features(encoded):
+    """
+        Returns a (rows, FEATURE_BINS) float16 array from a list of hex
+        encoded feature vectors, decoded in a single pass.
+    """
+    data = bytes.fromhex(''.join(encoded))
+    return np.frombuffer(data, '<f2').reshape(-1, FEATURE_BINS)
+
+def profile(hues, values, saturated=0.5):
+    """
+        Returns a target feature vector from hue bin weights and value
+        bin weights. The hue fractions sum to saturated, the share of
+        strongly coloured pixels, and the value fractions sum to 1.
+    """
+    hues = np.asarray(hues, np.float32)
+    values = np.asarray(values, np.float32)
+    return np.concatenate([saturated * hues / hues.sum(), values / values.sum()])
+
+# night wallpapers: reds and dark tones
+NIGHT_PROFILE = profile(
+    [3, 1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 3],
+    [2, 4, 4, 3, 2, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0])
+# day wallpapers: blues and bright tones
+DAY_PROFILE = profile(
+    [0, 0, 0, 1, 1, 1, 2, 3, 2, 1, 0, 0],
+    [0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 2, 2, 3, 3, 3, 2])
+
+##### Classes
+#####
+class FeatureIndex:
+    """
+        Holds the feature vectors of a catalog for nearest neighbour
+        selection. Vectors are kept as float32 for the distance sums.
+    """
+    def __init__(self, paths, features, neighbours=50):
+        """
+            paths is the list of image paths and features the matching
+            (len(paths), FEATURE_BINS) array. neighbours is k, the number
+            of nearest images a wallpaper is drawn from.
+        """
+        self.paths = paths
+        self.features = np.asarray(features, np.float32)
+        self.norms = np.einsum('ij,ij->i', self.features, self.features)
+        self.neighbours = max(1, min(neighbours, len(paths)))
+        self.levels = {}
+
+    @classmethod
+    def from_rows(cls, rows, neighbours=50):
+        """
+            Builds the index from catalog row dicts. Rows scanned before
+            feature vectors were stored are left out.
+        """
+        rows = [row for row in rows if row.get('features')]
+        features = decode_features([row['features'] for row in rows])
+        logging.debug("Feature index rows: %i", len(rows))
+        return cls([row['path'] for row in rows], features, neighbours)
+
+    def __len__(self):
+        return len(self.paths)
+
+    @staticmethod
+    def target(daylight):
+        """
+            Returns the target vector for a daylight level from 0 (night)
+            to 1 (day), a blend of the night and day profiles.
+        """
+        return (1 - daylight) * NIGHT_PROFILE + daylight * DAY_PROFILE
+
+    def nearest(self, target, k=None):
+        """
+            Returns the indexes of the k images nearest to target, nearest
+            first, by squared euclidean distance less the constant
+            squared length of target.
+        """
+        k = k or self.neighbours
+        distances = self.norms - 2 * (self.features @ target)
+        if k < len(distances):
+            nearest = np.argpartition(distances, k - 1)[:k]
+        else:
+            nearest = np.arange(len(distances))
+        return nearest[np.argsort(distances[nearest])]
+
+    def level(self, daylight):
+        """
+            Returns the quantised daylight level of a daylight value.
+        """
+        return int(round(min(max(daylight, 0), 1) * DAYLIGHT_LEVELS))
+
+    def candidates(self, daylight):
+        """
+            Returns the indexes of the k nearest images for the quantised
+            level of daylight, computed once per level.
+        """
+        level = self.level(daylight)
+        if level not in self.levels:
+            self.levels[level] = self.nearest(self.target(level / DAYLIGHT_LEVELS))
+        return self.levels[level]
+
+    def select(self, daylight):
+        """
+            Returns the path of a random image among the k nearest to the
+            profile of daylight.
+        """
+        candidates = self.candidates(daylight)
+        return self.paths[candidates[random.randrange(len(candidates))]]
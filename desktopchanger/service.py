@@ -0,0 +1,235 @@
+"""
+    Local wallpaper selection service. One process holds the catalog in
+    memory and answers "which wallpaper now" for any number of desktops,
+    so each seat no longer parses the catalog every minute.
+    Clients connect to a Unix socket and send one json request per line:
+
+        {"latitude": 51.5, "longitude": -0.1, "monitors": ["<property>", ...]}
+
+    and get one json line back:
+
+        {"night": true, "wallpapers": {"<property>": "<path>", ...}}
+
+    Night or day is worked out from the elevation of the sun at the
+    client's location, and every monitor of a request gets a different
+    wallpaper. A connection can send as many requests as it likes.
+    The catalog is held as one block of path bytes with an offset array
+    and an index array per night/day bucket, and is reloaded when the
+    catalog file changes.
+"""
+
+import os
+import json
+import time
+import random
+import socket
+import logging
+import threading
+import socketserver
+from array import array
+from desktopchanger import metrics
+from desktopchanger.utils import YamlFileIO, is_night_image, open_catalog
+from desktopchanger.sunequation import SunEquation, SUN_ALTITUDES
+
+# seconds between checks of the catalog file for changes
+RELOAD_INTERVAL = 1.0
+# longest a night/day answer for a location is reused, in seconds
+NIGHT_CACHE_SECONDS = 60
+# locations whose night/day answers are kept
+NIGHT_CACHE_SIZE = 4096
+DEFAULT_SOCKET = os.path.join("data", "selection.sock")
+
+##### Functions
+#####
+def request_wallpapers(socket_path, latitude, longitude, monitors, timeout=5):
+    """
+        Asks the service at socket_path for wallpapers for each monitor
+        of a desktop at latitude, longitude. Returns the response dict.
+        Raises ValueError if the service answered with an error.
+    """
+    request = {'latitude': latitude, 'longitude': longitude,
+               'monitors': list(monitors)}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode() + b'\n')
+        with client.makefile('rb') as stream:
+            line = stream.readline()
+    if not line:
+        raise ValueError("The selection service closed the connection")
+    response = json.loads(line)
+    if 'error' in response:
+        raise ValueError("Selection service: " + response['error'])
+    return response
+
+##### Classes
+#####
+class CompactCatalog:
+    """
+        Read only catalog of paths split into night and day buckets. All
+        paths share one bytes object, found by offset, so a million
+        wallpapers take little more memory than their path text.
+    """
+    def __init__(self, rows):
+        """
+            Builds the catalog from an iterable of catalog row dicts.
+        """
+        paths = bytearray()
+        self.offsets = array('Q', [0])
+        self.buckets = {True: array('I'), False: array('I')}
+        for row in rows:
+            night = row.get('night')
+            if night is None:
+                night = is_night_image(row['blue'], row['red'], row['light'])
+            self.buckets[bool(night)].append(len(self.offsets) - 1)
+            paths += row['path'].encode()
+            self.offsets.append(len(paths))
+        self.paths = bytes(paths)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def path(self, index):
+        """
+            Returns the path of wallpaper index.
+        """
+        return self.paths[self.offsets[index]:self.offsets[index + 1]].decode()
+
+    def pick(self, night, count):
+        """
+            Returns count random paths from the night or day bucket, all
+            different while the bucket is large enough.
+        """
+        bucket = self.buckets[night]
+        if not bucket:
+            raise ValueError("No {0} wallpapers in the catalog".format(
+                "night" if night else "day"))
+        if count <= len(bucket):
+            chosen = random.sample(range(len(bucket)), count)
+        else:
+            chosen = [random.randrange(len(bucket)) for _ in range(count)]
+        return [self.path(bucket[i]) for i in chosen]
+
+class SelectionService:
+    """
+        Serves wallpaper selections from one in-memory catalog over a
+        Unix socket.
+    """
+    def __init__(self, args):
+        """
+            Takes in the command line options and reads the contents
+            of the yaml configuration.
+        """
+        yaml_config = YamlFileIO("", "config.yaml")
+        yaml_config.read_yaml()
+        self.config = yaml_config.data
+        self.catalog = open_catalog(self.config)
+        if getattr(args, 'socket', None) is not None:
+            self.socket_path = args.socket
+        else:
+            self.socket_path = yaml_config.data.get('serviceSocket') or DEFAULT_SOCKET
+        self.compact = None
+        self.stamp = None
+        self.checked = 0
+        self.nights = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+            Returns the compact catalog, loading it again if the catalog
+            file changed. The file is checked at most once a
+            RELOAD_INTERVAL and only one thread reloads it, through its
+            own catalog object as SQLite connections stay in one thread.
+        """
+        now = time.monotonic()
+        if self.compact is not None and now - self.checked < RELOAD_INTERVAL:
+            return self.compact
+        with self.lock:
+            if self.compact is None or now - self.checked >= RELOAD_INTERVAL:
+                stat = os.stat(self.catalog.path)
+                stamp = (stat.st_mtime_ns, stat.st_size)
+                if stamp != self.stamp:
+                    catalog = open_catalog(self.config)
+                    with metrics.stage("service.load"):
+                        self.compact = CompactCatalog(catalog.iter_rows())
+                    if getattr(catalog, 'connection', None) is not None:
+                        catalog.connection.close()
+                    self.stamp = stamp
+                    logging.info("Catalog loaded: %i wallpapers", len(self.compact))
+                self.checked = now
+        return self.compact
+
+    def is_night(self, latitude, longitude):
+        """
+            True if the sun is below the horizon at the location. Answers
+            are reused per location for up to NIGHT_CACHE_SECONDS, but
+            never past the second the sun rises or sets. Expired answers
+            are dropped once NIGHT_CACHE_SIZE locations are cached.
+        """
+        import numpy as np
+        key = (round(latitude, 2), round(longitude, 2))
+        now = time.time()
+        cached = self.nights.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        # the elevation every second ahead, to find when the answer changes
+        seconds = now + np.arange(NIGHT_CACHE_SECONDS + 1)
+        nights = SunEquation(*key).elevation(seconds) < SUN_ALTITUDES['sun']
+        night = bool(nights[0])
+        changes = np.flatnonzero(nights != night)
+        expires = now + (changes[0] if len(changes) else NIGHT_CACHE_SECONDS)
+        if len(self.nights) >= NIGHT_CACHE_SIZE:
+            self.nights = {location: answer for location, answer in self.nights.items()
+                           if answer[0] > now}
+            if len(self.nights) >= NIGHT_CACHE_SIZE:
+                self.nights = {}
+        self.nights[key] = (float(expires), night)
+        return night
+
+    def answer(self, request):
+        """
+            Returns the response dict to a request dict.
+        """
+        latitude = float(request['latitude'])
+        longitude = float(request['longitude'])
+        monitors = list(request.get('monitors') or ['default'])
+        night = self.is_night(latitude, longitude)
+        paths = self.refresh().pick(night, len(monitors))
+        return {'night': night, 'wallpapers': dict(zip(monitors, paths))}
+
+    def serve(self):
+        """
+            Loads the catalog and answers requests until interrupted.
+        """
+        self.refresh()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = SelectionServer(self.socket_path, SelectionHandler)
+        server.service = self
+        logging.info("Serving wallpapers on %s", self.socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
+
+class SelectionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+        Unix socket server with a thread per connection.
+    """
+    daemon_threads = True
+    service = None
+
+class SelectionHandler(socketserver.StreamRequestHandler):
+    """
+        Answers each json request line of one connection.
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                with metrics.stage("service.answer"):
+                    response = self.server.service.answer(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e_info:
+                response = {'error': str(e_info)}
+            metrics.count("service.requests")
+            self.wfile.write(json.dumps(response).encode() + b'\n')
@@ -0,0 +1,183 @@
+"""
+    Persisted shuffle bag rotation. Every wallpaper of a bucket (night or
+    day) is shown once, in random order, before any is repeated.
+    A bag is a small binary file in data/: a header holding the cursor,
+    the number of entries and the stamp of the catalog it was built from,
+    followed by a permutation of 8 byte wallpaper ids. Taking the next
+    wallpaper reads the header and one id and writes the cursor back, so
+    it costs the same for ten or a million wallpapers.
+    When the catalog changes, removed wallpapers are dropped from the bag
+    and new ones are placed at random among those not yet shown this
+    cycle. The order of the others is kept.
+"""
+
+import os
+import sys
+import struct
+import random
+import hashlib
+import logging
+from array import array
+
+# magic, cursor, number of ids, catalog mtime_ns and size
+HEADER = struct.Struct('<8sQQqq')
+MAGIC = b'WPBAG001'
+ID_SIZE = 8
+
+##### Functions
+#####
+def path_id(path):
+    """
+        Returns the 8 byte blake2b hash of a path as an integer, the id
+        of a wallpaper held in memory rather than in a SQLite catalog.
+    """
+    digest = hashlib.blake2b(str(path).encode(), digest_size=ID_SIZE).digest()
+    return int.from_bytes(digest, 'little')
+
+##### Classes
+#####
+class ShuffleBag:
+    """
+        One bucket of wallpaper ids stored at path.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def next(self, stamp, ids):
+        """
+            Returns the next wallpaper id and advances the cursor, or None
+            if the bucket is empty. stamp identifies the catalog version,
+            for example its (mtime_ns, size). ids is a function returning
+            the ids of the bucket, only called when the bag was built from
+            another version of the catalog. Once every id was returned the
+            bag is shuffled again for the next cycle.
+        """
+        _, cursor, count, _, _ = self.current(stamp, ids)
+        if count == 0:
+            return None
+        if cursor >= count:
+            self.reshuffle()
+            cursor = 0
+        with open(self.path, 'r+b') as f:
+            f.seek(HEADER.size + ID_SIZE * cursor)
+            value = struct.unpack('<Q', f.read(ID_SIZE))[0]
+            f.seek(len(MAGIC))
+            f.write(struct.pack('<Q', cursor + 1))
+        return value
+
+    def peek(self, stamp, ids, ahead=0):
+        """
+            Returns the id ahead places after the cursor without moving
+            it, or None if the bucket is empty or the cycle ends first.
+            Arguments are those of next.
+        """
+        _, cursor, count, _, _ = self.current(stamp, ids)
+        if cursor + ahead >= count:
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(HEADER.size + ID_SIZE * (cursor + ahead))
+            return struct.unpack('<Q', f.read(ID_SIZE))[0]
+
+    def advance(self, stamp, steps):
+        """
+            Moves the cursor past steps ids returned by peek. Nothing is
+            done if the bag was rebuilt for another catalog version since.
+        """
+        header = self.read_header()
+        if header is None or (header[3], header[4]) != tuple(stamp):
+            return
+        with open(self.path, 'r+b') as f:
+            f.seek(len(MAGIC))
+            f.write(struct.pack('<Q', min(header[1] + steps, header[2])))
+
+    def current(self, stamp, ids):
+        """
+            Returns the header fields, updating the bag first if it was
+            built from another version of the catalog.
+        """
+        header = self.read_header()
+        if header is None or (header[3], header[4]) != tuple(stamp):
+            self.update(ids(), stamp)
+            header = self.read_header()
+        return header
+
+    def read_header(self):
+        """
+            Returns the header fields, or None if there is no valid bag.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                header = HEADER.unpack(f.read(HEADER.size))
+        except (FileNotFoundError, struct.error):
+            return None
+        if header[0] != MAGIC:
+            return None
+        return header
+
+    def read(self):
+        """
+            Returns the cursor, the ids and the stamp of the bag. A
+            missing or unreadable bag is empty.
+        """
+        header = self.read_header()
+        ids = array('Q')
+        if header is None:
+            return 0, ids, (0, 0)
+        with open(self.path, 'rb') as f:
+            f.seek(HEADER.size)
+            ids.frombytes(f.read(ID_SIZE * header[2]))
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        return header[1], ids, (header[3], header[4])
+
+    def write(self, cursor, ids, stamp):
+        """
+            Replaces the bag file in one step through a temporary file.
+        """
+        ids = array('Q', ids)
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, cursor, len(ids), stamp[0], stamp[1]))
+            f.write(ids.tobytes())
+        os.replace(temp_path, self.path)
+
+    def update(self, ids, stamp):
+        """
+            Brings the bag in line with the ids of a new catalog version.
+            Ids no longer in the catalog are removed. New ids are added at
+            random places among the ids still to come this cycle, one step
+            of an inside-out Fisher-Yates shuffle each, so the rest of
+            the order is kept.
+        """
+        cursor, old, _ = self.read()
+        wanted = set(ids)
+        drawn = [value for value in old[:cursor] if value in wanted]
+        undrawn = [value for value in old[cursor:] if value in wanted]
+        known = set(old)
+        added = 0
+        for value in wanted:
+            if value not in known:
+                undrawn.append(value)
+                position = random.randint(0, len(undrawn) - 1)
+                undrawn[-1], undrawn[position] = undrawn[position], undrawn[-1]
+                added += 1
+        self.write(len(drawn), drawn + undrawn, stamp)
+        logging.debug("Shuffle bag %s: %i shown, %i to come, %i added, %i removed",
+                      self.path, len(drawn), len(undrawn), added,
+                      len(old) + added - len(drawn) - len(undrawn))
+
+    def reshuffle(self):
+        """
+            Starts a new cycle with a new random order. The wallpaper
+            shown last is not allowed to come first.
+        """
+        _, ids, stamp = self.read()
+        last = ids[-1]
+        ids = list(ids)
+        random.shuffle(ids)
+        if len(ids) > 1 and ids[0] == last:
+            position = random.randint(1, len(ids) - 1)
+            ids[0], ids[position] = ids[position], ids[0]
+        self.write(0, ids, stamp)
@@ -1,15 +1,36 @@
 """
     The SunEquation class is used approximately calculate the sunset and
     sunrise times using the Sunrise Equation found on Wikipedia.
+    The SunTable class caches the times for a whole year on disk so that
+    a run only has to look the current day up.
+    SunEquation.elevation gives the height of the sun at any time and
+    SunEquation.boundaries the sunrise, sunset and twilight times of a
+    day, both vectorised with numpy.
 """
 
+import json
 import math
 import logging
+import os
 # from datetime import datetime, timezone
 import datetime
+import iso8601
 import pytz
 from tzlocal import get_localzone
 
+# altitude of the sun in degrees at each boundary of the day
+SUN_ALTITUDES = {
+    'sun': -0.83,
+    'civil': -6.0,
+    'nautical': -12.0,
+    'astronomical': -18.0,
+}
+# altitudes between which daylight goes from 0 (night) to 1 (day)
+NIGHT_ALTITUDE = SUN_ALTITUDES['astronomical']
+DAY_ALTITUDE = 6.0
+# bumped whenever the cached sun times would change
+SUN_TABLE_VERSION = 2
+
 
 class SunEquation:
     """
@@ -20,8 +41,11 @@ class SunEquation:
         minutes. #FUTURE: test the accuracy of this theory.
     """
 
-    def __init__(self, latitude, longitude):
-        self.date_today = datetime.date.today()
+    def __init__(self, latitude, longitude, date=None):
+        """
+            date is the day to calculate, today if not given.
+        """
+        self.date_today = date if date is not None else datetime.date.today()
         self.longitude_west = longitude
         self.latitude = latitude
         self.jdn = None
@@ -46,6 +70,161 @@ class SunEquation:
         self.suntimes(j_transit, w_o)
         return self.rise, self.set
 
+    def calculate_range(self, start, end):
+        """
+            Vectorised version of calculate for every day from start to
+            end inclusive using numpy. Each step repeats the formula of
+            the matching scalar method so the times are the same as
+            calling calculate for each day.
+            Returns the list of dates and lists of sunrise and sunset
+            datetime objects.
+        """
+        import numpy as np
+        dates = [start + datetime.timedelta(days=i)
+                 for i in range((end - start).days + 1)]
+        year = np.array([date.year for date in dates], dtype=float)
+        month = np.array([date.month for date in dates], dtype=float)
+        day = np.array([date.day for date in dates], dtype=float)
+        # julian_date and current_julian_day
+        jdn = ((1461*(year+4800+(month-14)/12))/4
+               + (367*(month-2-12*((month-14)/12)))/12
+               - (3*((year+4900+(month-14)/12)/100))/4
+               + day - 32075)
+        n = jdn - 2451545.0 + 0.0008
+        # mean_solar_moon, solar_mean_anomaly and equation_of_the_centre
+        j_star = n - (self.longitude_west/360)
+        m = (357.5291 + 0.98560028 * j_star) % 360
+        c = 1.9148*np.sin(np.radians(m))  \
+            + 0.0200*np.sin(np.radians(2*m)) \
+            + 0.0003*np.sin(np.radians(3*m))
+        # ecliptic_longitude, solar_transit and declination_of_the_sun
+        lam = (m + c + 180 + 102.9372) % 360
+        j_transit = 2451545.5 + j_star \
+                    + 0.0053*np.sin(np.radians(m)) \
+                    - 0.0069*np.sin(np.radians(2*lam))
+        theta = np.degrees(
+            np.arcsin(
+                np.sin(np.radians(lam))
+                * np.sin(np.radians(23.44))))
+        # hour_angle
+        w_o = np.degrees(
+            np.arccos(
+                (np.sin(np.radians(-0.83))
+                 - np.sin(np.radians(self.latitude))
+                 * np.sin(np.radians(theta)))
+                / (np.cos(
+                    np.radians(self.latitude))
+                   * np.cos(np.radians(theta)))))
+        # suntimes and julian_to_timedelta
+        tz = get_localzone()
+        times = []
+        for t_day in ((j_transit - w_o/360) - jdn, (j_transit + w_o/360) - jdn):
+            hour = np.floor(t_day*24)
+            minute = np.floor((t_day*24-hour)*60)
+            times.append([
+                (datetime.datetime(date.year, date.month, date.day,
+                                   tzinfo=pytz.timezone('UTC'))
+                 + datetime.timedelta(hours=int(h), minutes=int(mi))
+                 ).astimezone(tz)
+                for date, h, mi in zip(dates, hour, minute)])
+        self.timezone = tz
+        logging.debug("Calculated sun times from %s to %s", start, end)
+        return dates, times[0], times[1]
+
+    def boundaries(self):
+        """
+            Returns the sunrise, sunset and twilight times of the day as a
+            list of (datetime, name) tuples sorted by time, for example
+            (..., 'civil dawn') or (..., 'sun set'). Every altitude in
+            SUN_ALTITUDES is solved in one numpy call using the a offset
+            of hour_angle. Times are kept to the second rather than
+            floored to the minute like calculate. Boundaries the sun does
+            not cross on this day, such as in a polar summer, are left out.
+        """
+        import numpy as np
+        n = self.current_julian_day()
+        j_star = self.mean_solar_moon(n, self.longitude_west)
+        m = self.solar_mean_anomaly(j_star)
+        c = self.equation_of_the_centre(m)
+        lam = self.ecliptic_longitude(m, c)
+        j_transit = self.solar_transit(j_star, m, lam)
+        theta = self.declination_of_the_sun(lam)
+        names = list(SUN_ALTITUDES)
+        a = np.array([SUN_ALTITUDES[name] for name in names]) + 0.83
+        with np.errstate(invalid='ignore'):
+            w_o = np.degrees(
+                np.arccos(
+                    (np.sin(np.radians(-0.83+a))
+                     - np.sin(np.radians(self.latitude))
+                     * np.sin(np.radians(theta)))
+                    / (np.cos(np.radians(self.latitude))
+                       * np.cos(np.radians(theta)))))
+        tz = get_localzone()
+        midnight = datetime.datetime(
+            self.date_today.year, self.date_today.month, self.date_today.day,
+            tzinfo=pytz.timezone('UTC'))
+        events = []
+        for name, angle in zip(names, w_o):
+            if np.isnan(angle):
+                continue
+            rise = 'rise' if name == 'sun' else 'dawn'
+            fall = 'set' if name == 'sun' else 'dusk'
+            for label, j_time in ((rise, j_transit - angle/360),
+                                  (fall, j_transit + angle/360)):
+                moment = midnight + datetime.timedelta(days=float(j_time - self.jdn))
+                events.append((moment.astimezone(tz), name + ' ' + label))
+        self.timezone = tz
+        return sorted(events)
+
+    def elevation(self, timestamps):
+        """
+            Returns the elevation of the sun in degrees above the horizon
+            at an aware datetime, or a numpy array of elevations for a
+            sequence of aware datetimes or a numpy array of unix times in
+            seconds. Uses the same model as calculate, so the elevation at
+            sunrise and sunset is close to -0.83 degrees.
+        """
+        import numpy as np
+        single = isinstance(timestamps, datetime.datetime)
+        if single:
+            seconds = np.array([timestamps.timestamp()])
+        elif isinstance(timestamps, np.ndarray):
+            seconds = timestamps.astype(float)
+        else:
+            seconds = np.array([moment.timestamp() for moment in timestamps])
+        n = seconds/86400 + 2440587.5 - 2451545.0 + 0.0008
+        j_star = n - (self.longitude_west/360)
+        m = (357.5291 + 0.98560028 * j_star) % 360
+        c = 1.9148*np.sin(np.radians(m))  \
+            + 0.0200*np.sin(np.radians(2*m)) \
+            + 0.0003*np.sin(np.radians(3*m))
+        lam = (m + c + 180 + 102.9372) % 360
+        theta = np.arcsin(np.sin(np.radians(lam)) * np.sin(np.radians(23.44)))
+        # fraction of the UTC day of solar noon, as in solar_transit
+        noon = 0.5 + 0.0008 - (self.longitude_west/360) \
+            + 0.0053*np.sin(np.radians(m)) \
+            - 0.0069*np.sin(np.radians(2*lam))
+        hour_angle = np.radians(((seconds/86400 % 1 - noon) * 360 + 180) % 360 - 180)
+        latitude = math.radians(self.latitude)
+        altitude = np.degrees(np.arcsin(
+            math.sin(latitude) * np.sin(theta)
+            + math.cos(latitude) * np.cos(theta) * np.cos(hour_angle)))
+        if single:
+            return float(altitude[0])
+        return altitude
+
+    @staticmethod
+    def daylight(elevation):
+        """
+            Maps solar elevation to a smooth day level from 0 at the end
+            of astronomical twilight to 1 once the sun is DAY_ALTITUDE
+            degrees up. Works on floats and numpy arrays.
+        """
+        level = (elevation - NIGHT_ALTITUDE) / (DAY_ALTITUDE - NIGHT_ALTITUDE)
+        if isinstance(level, float):
+            return min(1.0, max(0.0, level))
+        return level.clip(0.0, 1.0)
+
     def current_julian_day(self):
         """
             Calculates the current julian calandar day.
@@ -138,16 +317,17 @@ class SunEquation:
     def hour_angle(self, latitude, theta, a=0):
         """
             Calculates the Hour angle.
+            a is added to the -0.83 degree sunrise altitude, for example
+            a = -5.17 gives the hour angle of civil twilight at -6 degrees.
         """
         w_o = math.degrees(
             math.acos(
-                (math.sin(
-                    math.radians(-0.83+a)
-                    - math.sin(math.radians(latitude))
-                    * math.sin(math.radians(theta)))
-                 / (math.cos(
-                     math.radians(latitude))
-                    * math.cos(math.radians(theta))))))
+                (math.sin(math.radians(-0.83+a))
+                 - math.sin(math.radians(latitude))
+                 * math.sin(math.radians(theta)))
+                / (math.cos(
+                    math.radians(latitude))
+                   * math.cos(math.radians(theta)))))
         logging.debug("Hour angle: %s", str(w_o))
         return w_o
 
@@ -165,9 +345,9 @@ class SunEquation:
         set_temp = self.julian_to_timedelta(t_set)
         tz = get_localzone() #Need to replace to reduce dependency by 1
         today = datetime.datetime(
-            datetime.date.today().year,
-            datetime.date.today().month,
-            datetime.date.today().day,
+            self.date_today.year,
+            self.date_today.month,
+            self.date_today.day,
             hour=0,
             tzinfo=pytz.timezone('UTC')
         )
@@ -199,7 +379,7 @@ class SunEquation:
             following ISO standards. This data can then be written to a
             file.
         """
-        today = datetime.date.today().isoformat()
+        today = self.date_today.isoformat()
         rise = self.rise.isoformat()
         fall = self.set.isoformat()
         timezone = self.rise.tzinfo.zone
@@ -215,3 +395,64 @@ class SunEquation:
             "timezone": timezone,
         }
         return output
+
+
+class SunTable:
+    """
+        Sunrise and sunset times for every day of a year. The year is
+        calculated in one vectorised SunEquation.calculate_range call
+        and cached as a json file in the data folder, keyed by latitude,
+        longitude, timezone and year, so most runs only look a day up.
+    """
+    def __init__(self, latitude, longitude, folder="data"):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.folder = folder
+        self.timezone = get_localzone()
+        self.year = None
+        self.days = {}
+
+    def path(self, year):
+        """
+            Returns the cache file path for a year.
+        """
+        zone = getattr(self.timezone, 'zone', str(self.timezone))
+        name = "suntimes{0}_{1}_{2}_{3}_{4}.json".format(
+            SUN_TABLE_VERSION, self.latitude, self.longitude,
+            zone.replace('/', '-'), year)
+        return os.path.join(self.folder, name)
+
+    def lookup(self, date):
+        """
+            Returns the sunrise and sunset datetime objects of a date,
+            loading or calculating its year first if needed.
+        """
+        if self.year != date.year:
+            self.load(date.year)
+        rise, fall = self.days[date.isoformat()]
+        return iso8601.parse_date(rise), iso8601.parse_date(fall)
+
+    def load(self, year):
+        """
+            Reads the cached year or calculates and caches it.
+        """
+        path = self.path(year)
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.days = json.load(f)
+            logging.debug("Sun times read from %s", path)
+        else:
+            sun_times = SunEquation(self.latitude, self.longitude)
+            dates, rises, sets = sun_times.calculate_range(
+                datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+            self.days = {
+                date.isoformat(): [rise.isoformat(), fall.isoformat()]
+                for date, rise, fall in zip(dates, rises, sets)}
+            try:
+                with open(path, 'w') as f:
+                    json.dump(self.days, f)
+            except IOError as e_info:
+                print(e_info)
+                raise
+            logging.debug("Sun times calculated and written to %s", path)
+        self.year = year
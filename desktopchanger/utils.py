@@ -1,12 +1,102 @@
 """ This file contains shared classes and functions.
     * yamlFileIO returns the contents of the config.yaml file as a dict
     * CSVFileIO is used to read from or write to a .csv file.
+    * SQLiteFileIO is used to read from or write to a SQLite catalog.
+    * open_catalog returns the catalog chosen in config.yaml.
+    * AnalysisCache stores image analysis results by content hash.
+    pandas is only imported by the methods which need it so that
+    updatedesktop.py can start without it.
 """
+import csv
+import hashlib
 import logging
 import os
+import sqlite3
+from itertools import islice
 from pathlib import Path
-import pandas
 import yaml
+from desktopchanger import metrics
+
+# columns stored for each wallpaper in the catalog
+FIELDNAMES = ['path', 'blue', 'green', 'red', 'light', 'dark', 'size', 'mtime',
+              'night', 'features', 'width', 'height', 'aspect']
+# columns holding whole numbers and text, the others are floats
+INTEGER_FIELDS = {'size', 'mtime', 'night', 'width', 'height'}
+TEXT_FIELDS = {'path', 'features'}
+# wallpapers under the red and blue limits and over the light limit are
+# shown at night
+NIGHT_RED = 0.15
+NIGHT_BLUE = 0.1
+NIGHT_LIGHT = 0.15
+NIGHT_CONDITION = "red < {0} AND blue < {1} AND light > {2}".format(
+    NIGHT_RED, NIGHT_BLUE, NIGHT_LIGHT)
+# analysis results kept by the analysis cache
+ANALYSIS_FIELDS = ['blue', 'green', 'red', 'light', 'dark', 'features']
+# bytes read at a time when hashing an image file
+HASH_CHUNK = 1 << 20
+
+##### Functions
+#####
+def chunks(rows, size):
+    """
+        Splits an iterable into lists of at most size items, pulling
+        only one list at a time from the iterable.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def is_night_image(blue, red, light):
+    """
+        Returns 1 if an image with these fractions is a night wallpaper
+        and 0 if it is a day wallpaper. Stored in the night column at
+        scan time so the split is not repeated on every update.
+    """
+    return int(red < NIGHT_RED and blue < NIGHT_BLUE and light > NIGHT_LIGHT)
+
+def file_digest(path):
+    """
+        Returns the 16 byte blake2b digest of the contents of a file.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(block)
+    return digest.digest()
+
+def replace_file(temp_path, path):
+    """
+        Moves a fully written temporary file over path in one step. The
+        file and then the rename are flushed to disk, so after a crash
+        path holds either the old or the new contents, never a part.
+    """
+    with open(temp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    folder = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(folder)
+    finally:
+        os.close(folder)
+
+def open_catalog(config):
+    """
+        Returns the catalog io object selected by the 'catalog' key of
+        the config.yaml dict: 'csv' (default) or 'sqlite'. A new SQLite
+        catalog is filled from the existing csv file on first use.
+    """
+    csv_io = CSVFileIO(config['csvFile'])
+    if config.get('catalog', 'csv') == 'csv':
+        return csv_io
+    if config['catalog'] != 'sqlite':
+        raise ValueError("catalog must be 'csv' or 'sqlite'")
+    sqlite_io = SQLiteFileIO(config.get('sqliteFile') or 'wallpapers.db')
+    if not os.path.isfile(sqlite_io.path) and os.path.isfile(csv_io.path):
+        sqlite_io.migrate_csv(csv_io)
+    return sqlite_io
 
 ##### Classes
 #####
@@ -15,6 +105,9 @@ class CSVFileIO:
         This class is used to read and write to data to and from a
         chosen csv file.
     """
+    # rows written to the file between flushes
+    chunk_size = 1000
+
     def __init__(self, csvfile):
         self.data = []
         folder = os.path.join(os.getcwd(), "data")
@@ -22,18 +115,404 @@ class CSVFileIO:
 
     def read_file(self):
         """
-            Reads the entire csv file.
+            Reads the entire csv file into a pandas DataFrame.
         """
-        self.data.clear()
+        import pandas
         self.data = pandas.read_csv(self.path, index_col='path')
         logging.debug("Rows: read: %i", len(self.data))
         return self.data
 
+    def read_rows(self):
+        """
+            Reads the entire csv file into a list of dicts using the csv
+            module. Numeric columns are converted to ints or floats and
+            empty values to None. Used where importing pandas would cost
+            more than the work itself.
+        """
+        self.data = list(self.iter_rows())
+        logging.debug("Rows: read: %i", len(self.data))
+        return self.data
+
+    def iter_rows(self):
+        """
+            Yields the rows of read_rows one at a time, so a large catalog
+            can be turned into another form without holding every dict.
+        """
+        with open(self.path, newline='') as f:
+            reader = csv.DictReader(f)
+            numeric = [(name, int if name in INTEGER_FIELDS else float)
+                       for name in reader.fieldnames if name not in TEXT_FIELDS]
+            for row in reader:
+                for name, convert in numeric:
+                    row[name] = convert(row[name]) if row[name] != '' else None
+                yield row
+
+    def write_file(self, data, fieldnames):
+        """
+            Writes wallpapers to a csv file, replaced in one step
+            through a temporary file as in write_rows.
+        """
+        temp_path = self.path + ".tmp"
+        data.to_csv(temp_path, index=False, columns=fieldnames)
+        replace_file(temp_path, self.path)
+
+    def write_rows(self, rows, fieldnames):
+        """
+            Streams an iterable of row dicts to the csv file, chunk_size
+            rows at a time. The rows go to a temporary file beside the
+            catalog which replaces it once every row is written, so
+            neither a reader nor a crash sees a partly written catalog.
+        """
+        temp_path = self.path + ".tmp"
+        count = 0
+        with open(temp_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            for chunk in chunks(rows, self.chunk_size):
+                with metrics.stage("catalog.write"):
+                    writer.writerows(chunk)
+                    f.flush()
+                count += len(chunk)
+        replace_file(temp_path, self.path)
+        logging.debug("Rows written: %i", count)
+
+    def update_rows(self, rows, removed=(), removed_folders=()):
+        """
+            Applies changes to the catalog: paths in removed and every
+            path inside removed_folders are deleted, then each row dict
+            in rows is added or replaces the row of the same path. The
+            file is rewritten in one go through write_rows.
+        """
+        current = {}
+        if os.path.isfile(self.path):
+            current = {row['path']: row for row in self.read_rows()}
+        removed = set(removed)
+        prefixes = tuple(os.path.join(folder, '') for folder in removed_folders)
+        for path in list(current):
+            if path in removed or (prefixes and path.startswith(prefixes)):
+                del current[path]
+        for row in rows:
+            current[row['path']] = row
+        self.write_rows(current.values(), FIELDNAMES)
+
+class SQLiteFileIO:
+    """
+        This class is used to read and write wallpapers to and from a
+        SQLite catalog. The colour columns are indexed so the day/night
+        filter and the random pick of updatedesktop.py are indexed queries
+        rather than a parse of the whole catalog.
+    """
+    # rows sent to sqlite in each executemany call
+    batch_size = 1000
+
+    def __init__(self, dbfile):
+        self.data = []
+        folder = os.path.join(os.getcwd(), "data")
+        self.path = os.path.join(folder, dbfile)
+        self.connection = None
+
+    def connect(self):
+        """
+            Opens the database, creating the table and indexes if needed,
+            and returns the connection.
+        """
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            columns = ', '.join(
+                name + (' TEXT PRIMARY KEY' if name == 'path'
+                        else ' TEXT' if name in TEXT_FIELDS
+                        else ' INTEGER' if name in INTEGER_FIELDS
+                        else ' REAL')
+                for name in FIELDNAMES)
+            with self.connection:
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS wallpapers (" + columns + ")")
+                existing = [row[1] for row in self.connection.execute(
+                    "PRAGMA table_info(wallpapers)")]
+                if 'night' not in existing:
+                    # catalog from before the night column was stored
+                    self.connection.execute(
+                        "ALTER TABLE wallpapers ADD COLUMN night INTEGER")
+                    self.connection.execute(
+                        "UPDATE wallpapers SET night = (" + NIGHT_CONDITION + ")")
+                if 'features' not in existing:
+                    # catalog from before feature vectors were stored
+                    self.connection.execute(
+                        "ALTER TABLE wallpapers ADD COLUMN features TEXT")
+                for name in ('width', 'height', 'aspect'):
+                    if name not in existing:
+                        # catalog from before image sizes were stored
+                        self.connection.execute(
+                            "ALTER TABLE wallpapers ADD COLUMN " + name
+                            + (" INTEGER" if name in INTEGER_FIELDS else " REAL"))
+                for name in ('red', 'blue', 'light', 'dark', 'night'):
+                    self.connection.execute(
+                        "CREATE INDEX IF NOT EXISTS wallpapers_{0} "
+                        "ON wallpapers ({0})".format(name))
+        return self.connection
+
+    def read_file(self):
+        """
+            Reads the entire catalog into a pandas DataFrame.
+        """
+        import pandas
+        self.data = pandas.read_sql_query(
+            "SELECT * FROM wallpapers", self.connect(), index_col='path')
+        logging.debug("Rows: read: %i", len(self.data))
+        return self.data
+
+    def read_rows(self):
+        """
+            Reads the entire catalog into a list of dicts.
+        """
+        self.data = list(self.iter_rows())
+        logging.debug("Rows: read: %i", len(self.data))
+        return self.data
+
+    def iter_rows(self):
+        """
+            Yields the rows of read_rows one at a time.
+        """
+        cursor = self.connect().execute("SELECT * FROM wallpapers")
+        names = [column[0] for column in cursor.description]
+        for row in cursor:
+            yield dict(zip(names, row))
+
     def write_file(self, data, fieldnames):
         """
-            Writes wallpapers to a csv file.
+            Replaces the catalog with the wallpapers of a DataFrame.
+        """
+        self.write_rows(data[fieldnames].to_dict('records'), fieldnames)
+
+    def write_rows(self, rows, fieldnames):
+        """
+            Replaces the catalog with an iterable of row dicts. Rows are
+            upserted and committed a batch at a time so finished work is
+            kept if the scan stops. Wallpapers which were not in rows are
+            deleted once every row is written.
+        """
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS scanned (path TEXT PRIMARY KEY)")
+            connection.execute("DELETE FROM scanned")
+        count = 0
+        values = ([row.get(name) for name in fieldnames] for row in rows)
+        for batch in self.batches(values):
+            with metrics.stage("catalog.write"), connection:
+                self.upsert(batch, fieldnames)
+                connection.executemany(
+                    "INSERT OR IGNORE INTO scanned VALUES (?)",
+                    [(row[fieldnames.index('path')],) for row in batch])
+            count += len(batch)
+        with connection:
+            connection.execute(
+                "DELETE FROM wallpapers WHERE path NOT IN (SELECT path FROM scanned)")
+        logging.debug("Rows written: %i to %s", count, self.path)
+
+    def update_rows(self, rows, removed=(), removed_folders=()):
+        """
+            Applies changes to the catalog in one transaction: paths in
+            removed and every path inside removed_folders are deleted,
+            then the row dicts in rows are upserted.
+        """
+        connection = self.connect()
+        with connection:
+            connection.executemany(
+                "DELETE FROM wallpapers WHERE path = ?",
+                [(path,) for path in removed])
+            for folder in removed_folders:
+                prefix = os.path.join(folder, '')
+                connection.execute(
+                    "DELETE FROM wallpapers WHERE substr(path, 1, ?) = ?",
+                    (len(prefix), prefix))
+            values = ([row[name] for name in FIELDNAMES] for row in rows)
+            for batch in self.batches(values):
+                self.upsert(batch, FIELDNAMES)
+
+    def upsert(self, rows, fieldnames):
+        """
+            Inserts or updates a batch of rows, each a sequence of values
+            in fieldnames order. The caller commits.
+        """
+        updates = ', '.join(
+            "{0}=excluded.{0}".format(name) for name in fieldnames if name != 'path')
+        self.connect().executemany(
+            "INSERT INTO wallpapers (" + ', '.join(fieldnames) + ") "
+            "VALUES (" + ', '.join('?' * len(fieldnames)) + ") "
+            "ON CONFLICT(path) DO UPDATE SET " + updates,
+            rows)
+
+    def batches(self, rows):
+        """
+            Splits an iterable of rows into lists of batch_size rows.
+            numpy scalars from pandas are turned into python numbers
+            which sqlite can store.
+        """
+        for chunk in chunks(rows, self.batch_size):
+            yield [tuple(value.item() if hasattr(value, 'item') else value
+                         for value in row)
+                   for row in chunk]
+
+    def migrate_csv(self, csv_io):
+        """
+            One-time import of an existing csv catalog. Columns missing
+            from older csv files are stored as NULL, apart from night
+            which is worked out from the colour fractions.
+        """
+        rows = csv_io.read_rows()
+        for row in rows:
+            if row.get('night') is None:
+                row['night'] = is_night_image(row['blue'], row['red'], row['light'])
+        connection = self.connect()
+        with connection:
+            for batch in self.batches(
+                    [row.get(name) for name in FIELDNAMES] for row in rows):
+                self.upsert(batch, FIELDNAMES)
+        logging.debug("Migrated %i rows from %s", len(rows), csv_io.path)
+
+    def rowid_range(self, is_night_time):
+        """
+            Returns the lowest and highest rowid of the night or day
+            wallpapers, or None if there are none. Both are single seeks
+            of the night index, which holds the rowids in order.
+        """
+        connection = self.connect()
+        ends = [connection.execute(
+            "SELECT rowid FROM wallpapers WHERE " + self.condition(is_night_time)
+            + " ORDER BY rowid " + order + " LIMIT 1").fetchone()
+                for order in ("ASC", "DESC")]
+        if ends[0] is None:
+            return None
+        return ends[0][0], ends[1][0]
+
+    def path_from(self, is_night_time, rowid):
+        """
+            Returns the path of the first night or day wallpaper at or
+            after rowid, found by a seek of the night index, or None if
+            there is none.
         """
-        data.to_csv(self.path, index=False, columns=fieldnames)
+        row = self.connect().execute(
+            "SELECT path FROM wallpapers WHERE " + self.condition(is_night_time)
+            + " AND rowid >= ? ORDER BY rowid LIMIT 1", (rowid,)).fetchone()
+        return row[0] if row is not None else None
+
+    def ids(self, is_night_time):
+        """
+            Returns the rowids of the night or day wallpapers. Rowids stay
+            the same while a path is in the catalog, upserts keep them.
+        """
+        return [row[0] for row in self.connect().execute(
+            "SELECT rowid FROM wallpapers WHERE " + self.condition(is_night_time))]
+
+    def path_of(self, rowid):
+        """
+            Returns the path of the wallpaper with rowid, or None.
+        """
+        row = self.connect().execute(
+            "SELECT path FROM wallpapers WHERE rowid = ?", (rowid,)).fetchone()
+        return row[0] if row is not None else None
+
+    @staticmethod
+    def condition(is_night_time):
+        """
+            SQL condition selecting night or day wallpapers from the
+            indexed night column.
+        """
+        return "night = " + str(int(is_night_time))
+
+class AnalysisCache:
+    """
+        SQLite store of image analysis results keyed by the blake2b
+        digest of the file contents, the decode scale and whether the
+        image was analysed whole or in strips, as set by tiled. Copies of an
+        image under other paths, and images which were moved or renamed,
+        are found by their contents and are not analysed again.
+        Results are committed batch_size at a time and on flush.
+    """
+    # results written in each transaction
+    batch_size = 1000
+
+    def __init__(self, dbfile, tiled=False):
+        folder = os.path.join(os.getcwd(), "data")
+        self.path = os.path.join(folder, dbfile)
+        self.tiled = int(bool(tiled))
+        self.connection = None
+        self.pending = {}
+
+    def connect(self):
+        """
+            Opens the database, creating the table if needed, and returns
+            the connection.
+        """
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            columns = ', '.join(
+                name + (' TEXT' if name in TEXT_FIELDS else ' REAL')
+                for name in ANALYSIS_FIELDS)
+            with self.connection:
+                existing = [row[1] for row in self.connection.execute(
+                    "PRAGMA table_info(analysis)")]
+                if existing and 'features' not in existing:
+                    # cache from before feature vectors were stored
+                    self.connection.execute(
+                        "ALTER TABLE analysis ADD COLUMN features TEXT")
+                untiled = existing and 'tiled' not in existing
+                if untiled:
+                    # cache from before the tiling mode was part of the key
+                    self.connection.execute(
+                        "ALTER TABLE analysis RENAME TO analysis_untiled")
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS analysis (digest BLOB, scale INTEGER, "
+                    "tiled INTEGER, " + columns
+                    + ", PRIMARY KEY (digest, scale, tiled)) WITHOUT ROWID")
+                if untiled:
+                    fields = ', '.join(ANALYSIS_FIELDS)
+                    self.connection.execute(
+                        "INSERT INTO analysis (digest, scale, tiled, " + fields + ") "
+                        "SELECT digest, scale, 0, " + fields + " FROM analysis_untiled")
+                    self.connection.execute("DROP TABLE analysis_untiled")
+        return self.connection
+
+    def get(self, digest, scale):
+        """
+            Returns the blue, green, red, light and dark fractions and the
+            feature vector stored for digest at scale in this tiling mode,
+            or None if the image was never analysed so or was cached
+            without features.
+        """
+        result = self.pending.get((digest, scale, self.tiled))
+        if result is not None:
+            return result
+        return self.connect().execute(
+            "SELECT " + ', '.join(ANALYSIS_FIELDS)
+            + " FROM analysis WHERE digest = ? AND scale = ? AND tiled = ?"
+            " AND features IS NOT NULL", (digest, scale, self.tiled)).fetchone()
+
+    def put(self, digest, scale, result):
+        """
+            Stores the analysis result of the image with digest at scale.
+        """
+        *fractions, features = result
+        self.pending[(digest, scale, self.tiled)] = tuple(float(value) for value in fractions) \
+            + (features,)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+            Writes the results waiting to be stored.
+        """
+        if not self.pending:
+            return
+        with self.connect():
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO analysis (digest, scale, tiled, "
+                + ', '.join(ANALYSIS_FIELDS) + ") VALUES ("
+                + ', '.join('?' * (len(ANALYSIS_FIELDS) + 3)) + ")",
+                [key + result for key, result in self.pending.items()])
+        logging.debug("Analysis results cached: %i", len(self.pending))
+        self.pending = {}
 
 class YamlFileIO:
     """
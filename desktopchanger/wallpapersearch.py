@@ -1,21 +1,80 @@
 """
     WallpaperSearch traverses a given folder and find images files.
-    This will be turned into a database set at a later date.
-    For now the behaviour is to analyse each image in a single directory
-    and extract the full path and information about the image.
-
-    Improvements
-    *fieldnames variable should only exist in one place
+    The scan is a pipeline of generators: the folder walk yields image
+    files, analysis yields catalog rows and the catalog writer stores
+    them in chunks. Each stage pulls from the one before, so analysis
+    starts with the first file found and memory stays flat however large
+    the library is.
+    The size and modification time of each file are stored alongside the
+    analysis so that an incremental scan only analyses new or changed
+    files. Analysis results are also cached by a hash of the file
+    contents so duplicate, moved and renamed images are analysed once.
+    Before any decode the header of each file is read to reject damaged,
+    truncated and too small images and to store the image size.
+    Finished images and folders are journalled as the scan goes so that
+    a stopped scan can be resumed, see checkpoint.py.
 """
 
+import os
 import logging
+import time
+from itertools import chain
+from collections import deque
+from functools import partial
 from pathlib import Path
-import pandas
-from desktopchanger.utils import YamlFileIO, CSVFileIO
-from desktopchanger.imageanalysis import ImageAnalysis
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+from desktopchanger.utils import YamlFileIO, FIELDNAMES, is_night_image, \
+    open_catalog, file_digest, AnalysisCache
+from desktopchanger.imageanalysis import ImageAnalysis, sniff_image, large_enough, \
+    fitting_scale
+from desktopchanger.imagereader import readahead
+from desktopchanger.checkpoint import ScanCheckpoint
+from desktopchanger.rendercache import parse_size
+from desktopchanger.selection import encode_features
+from desktopchanger import watcher, metrics
 
 # common image types
 IMAGE_FORMATS = {".jpg", ".jpeg", ".png"}
+# images queued for analysis per worker process
+QUEUE_PER_WORKER = 4
+
+##### Functions
+#####
+def analyse_image(path_str, scale=1, max_bytes=None, mapped=False):
+    """
+        Analyse a single image and return its blue, green, red, light
+        and dark fractions and its encoded feature vector. mapped decodes
+        from a memory mapping of the file. Returns None
+        if the image could not be read
+        so that one bad file does not stop the whole batch.
+        Kept at module level so it can be sent to worker processes.
+    """
+    try:
+        with metrics.stage("scan.analyse"):
+            image_analyse = ImageAnalysis(path_str, scale, max_bytes, mapped)
+            fractions = image_analyse.analyse_hsv()
+            return fractions + (encode_features(image_analyse.analyse_features()),)
+    except (OSError, ValueError, cv2.error) as e_info:
+        logging.warning("Skipping image %s: %s", path_str, repr(e_info))
+        metrics.count("scan.images_failed")
+        return None
+
+def analyse_image_measured(path_str, scale=1, max_bytes=None, mapped=False):
+    """
+        analyse_image for worker processes. Returns the analysis together
+        with the metrics the worker recorded for it, so that the parent
+        process can merge them.
+    """
+    result = analyse_image(path_str, scale, max_bytes, mapped)
+    return result, metrics.METRICS.pop()
+
+def size_fields(width, height):
+    """
+        Returns the width, height and aspect ratio catalog fields of an
+        image.
+    """
+    return {'width': width, 'height': height, 'aspect': round(width / height, 4)}
 
 ##### Classes
 #####
@@ -26,7 +85,6 @@ class WallpaperSearch:
     """
     def __init__(self, args):
         try:
-            self.image_data = []
             yaml_config = YamlFileIO("", "config.yaml")
             yaml_config.read_yaml()
             # Setting base wallpaper folder
@@ -36,86 +94,473 @@ class WallpaperSearch:
                 self.folder = Path(str(yaml_config.data['wallpapersFolder']))
             if not self.folder.is_dir():
                 raise NotADirectoryError
-            #setting up csv_io
-            csv_file = yaml_config.data['csvFile']
-            self.csv_io = CSVFileIO(csv_file)
+            #setting up the csv or sqlite catalog
+            self.catalog = open_catalog(yaml_config.data)
+            # Number of worker processes used to analyse images
+            if getattr(args, 'workers', None) is not None:
+                self.workers = args.workers
+            else:
+                self.workers = yaml_config.data.get('workers') or 1
+            if self.workers < 1:
+                raise ValueError("workers must be 1 or more")
+            # Reuse results of unchanged files from the existing csv file
+            self.incremental = bool(getattr(args, 'incremental', False)
+                                    or yaml_config.data.get('incremental'))
+            self.previous = {}
+            # Decode reduction factor for image analysis
+            if getattr(args, 'scale', None) is not None:
+                self.scale = args.scale
+            else:
+                self.scale = yaml_config.data.get('decodeScale') or 1
+            # Memory cap of the tiled analysis, decoded image included,
+            # unset for whole images
+            memory_mb = yaml_config.data.get('analysisMemoryMB')
+            self.max_bytes = int(memory_mb * 2**20) if memory_mb else None
+            # Decode from memory mapped files instead of imread's own reads
+            self.mapped = bool(yaml_config.data.get('mappedRead'))
+            # Files read into the page cache ahead of analysis, 0 for none
+            self.readahead = yaml_config.data.get('readAhead') or 0
+            # Seconds without file events before watch mode updates
+            self.debounce = yaml_config.data.get('watchDebounce') or 2
+            # Analysis results cached by file contents, unset to disable
+            cache_file = yaml_config.data.get('analysisCache')
+            self.cache = AnalysisCache(cache_file, bool(self.max_bytes)) \
+                if cache_file else None
+            self.in_flight = set()
+            # Seconds between checkpoint writes, 0 disables checkpoints
+            interval = yaml_config.data.get('checkpointInterval', 30)
+            self.checkpoint = None
+            if interval:
+                self.checkpoint = ScanCheckpoint(os.path.join(
+                    os.getcwd(), "data", "scan_checkpoint.jsonl"), interval)
+            # Images smaller than this in either orientation are skipped
+            min_resolution = yaml_config.data.get('minResolution')
+            self.min_size = (0, 0)
+            if min_resolution:
+                self.min_size = parse_size(min_resolution, 'minResolution')
+            # Carry on from the checkpoint of a scan that was stopped
+            self.resume = bool(getattr(args, 'resume', False))
         except NotADirectoryError:
             print("The path supplied must be a folder \n")
             raise
 
     def search_folder(self):
         """
-            Main method which recursively processes the path and builds
-            a list of images which are saved to a file.
+            Main method which streams the images found in the folder tree
+            through analysis into the catalog.
+            When resuming, the folders the checkpoint lists as finished
+            are not walked again and their rows come from the checkpoint,
+            which is only removed once the catalog is written.
         """
-        image_files = self.process_path()
-        self.process_images(image_files)
-        self.save_file()
+        if self.incremental:
+            self.load_previous()
+        root = os.path.abspath(str(self.folder))
+        done_rows = []
+        finished = {}
+        if self.checkpoint is not None:
+            rows = {}
+            if self.resume:
+                rows, finished = self.checkpoint.load(root, self.scale)
+                self.previous.update(rows)
+                done_rows = [row for path, row in rows.items()
+                             if os.path.dirname(path) in finished]
+            self.checkpoint.open(root, self.scale, bool(rows or finished))
+        elif self.resume:
+            logging.warning("checkpointInterval is 0, nothing to resume")
+        try:
+            image_files = self.process_path(finished)
+            rows = chain(done_rows, self.process_images(image_files))
+            self.save_file(rows)
+        finally:
+            if self.checkpoint is not None:
+                self.checkpoint.close()
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
 
-    def process_path(self):
+    def watch(self):
         """
-            Convert the folder and path into a list of additional
-            folders to search through and files to check if they are
-            images.
-            All image files are returned as a list.
+            Keeps the catalog live with inotify. The folders are watched
+            first, then an incremental scan brings the catalog up to date. Then images created,
+            modified or moved in are analysed and added, and images or
+            folders deleted or moved out are removed. Bursts of events are
+            debounced: changes are applied once no event has arrived for
+            self.debounce seconds, or ten times that after the first
+            pending change even if events never stop. Runs until
+            interrupted.
+        """
+        inotify = watcher.Inotify()
+        pending = {}
+        removed_folders = set()
+        first_event = None
+        try:
+            # watched before the scan, so changes made while it runs are
+            # queued as events rather than lost
+            self.watch_folder(inotify, os.path.abspath(str(self.folder)), pending)
+            pending.clear()
+            self.incremental = True
+            self.search_folder()
+            self.previous = {}
+            while True:
+                timeout = None
+                if pending or removed_folders:
+                    timeout = first_event + 10*self.debounce - time.time()
+                    if timeout <= 0:
+                        # events never stopped, apply before reading more
+                        self.apply_changes(pending, removed_folders)
+                        first_event = None
+                        continue
+                    timeout = min(self.debounce, timeout)
+                events = inotify.read_events(timeout)
+                if not events:
+                    self.apply_changes(pending, removed_folders)
+                    first_event = None
+                    continue
+                for path, mask in events:
+                    if path is None:
+                        # events were lost, catch up with a rescan
+                        pending.clear()
+                        removed_folders.clear()
+                        first_event = None
+                        self.incremental = True
+                        self.search_folder()
+                        self.previous = {}
+                    elif mask & watcher.IN_ISDIR:
+                        if mask & (watcher.IN_CREATE | watcher.IN_MOVED_TO):
+                            removed_folders.discard(path)
+                            self.watch_folder(inotify, path, pending)
+                        elif mask & (watcher.IN_DELETE | watcher.IN_MOVED_FROM):
+                            inotify.remove_watch(path)
+                            removed_folders.add(path)
+                    elif os.path.splitext(path)[1].lower() in IMAGE_FORMATS:
+                        if mask & (watcher.IN_CLOSE_WRITE | watcher.IN_MOVED_TO):
+                            pending[path] = True
+                        elif mask & (watcher.IN_DELETE | watcher.IN_MOVED_FROM):
+                            pending[path] = False
+                if first_event is None and (pending or removed_folders):
+                    first_event = time.time()
+        finally:
+            inotify.close()
+
+    def watch_folder(self, inotify, folder, pending):
+        """
+            Watches folder and every folder below it. Images already in
+            them are marked as pending updates, as happens when a folder
+            full of images is moved into the tree.
+        """
+        folderlist = [folder]
+        while folderlist:
+            folder = folderlist.pop()
+            try:
+                inotify.add_watch(folder)
+                filelist, newfolderslist = WallpaperSearch.process_folder(folder)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            folderlist.extend(newfolderslist)
+            for path_str, _ in filelist:
+                pending[path_str] = True
+        logging.debug("Watching folders: %i", len(inotify.watches))
+
+    def apply_changes(self, pending, removed_folders):
+        """
+            Analyses the pending updates and writes them, together with
+            the pending removals, to the catalog. Both are then cleared.
+            Updated images the pre-filter rejects or analysis fails on
+            are removed, as a full scan would leave them out.
         """
         image_files = []
-        folderlist = [self.folder]
+        removed = []
+        for path_str, exists in pending.items():
+            try:
+                if exists:
+                    image_files.append((path_str, os.stat(path_str)))
+                    continue
+            except FileNotFoundError:
+                pass
+            removed.append(path_str)
+        rows = list(self.process_images(image_files))
+        written = {row['path'] for row in rows}
+        removed.extend(path_str for path_str, _ in image_files if path_str not in written)
+        self.catalog.update_rows(rows, removed, removed_folders)
+        logging.debug("Watch updated: %i, removed: %i, folders removed: %i",
+                      len(rows), len(removed), len(removed_folders))
+        pending.clear()
+        removed_folders.clear()
+
+    def load_previous(self):
+        """
+            Reads the existing catalog into a dict keyed by path so that
+            unchanged images can be reused rather than analysed again.
+            A catalog written without the size and mtime columns is
+            ignored and every image is analysed.
+        """
+        self.previous = {}
+        if not os.path.isfile(self.catalog.path):
+            logging.debug("No previous catalog, analysing all images")
+            return
+        rows = self.catalog.read_rows()
+        if rows and not {'size', 'mtime'}.issubset(rows[0]):
+            logging.debug("Previous catalog has no size/mtime columns")
+            return
+        for row in rows:
+            if not row.get('features'):
+                # scanned before feature vectors, analyse again
+                continue
+            if row.get('night') is None:
+                row['night'] = is_night_image(row['blue'], row['red'], row['light'])
+            self.previous[row['path']] = {name: row.get(name) for name in FIELDNAMES}
+        logging.debug("Previous images loaded: %i", len(self.previous))
+
+    def process_path(self, finished=None):
+        """
+            Walks the folder tree with os.scandir, one folder at a time,
+            and yields the path string and os.stat result of every image
+            file found. finished maps folders to skip, already scanned by
+            a resumed scan, to their subfolders, which are still walked.
+        """
+        finished = finished or {}
+        folderlist = [os.path.abspath(str(self.folder))]
         while folderlist:
-            filelist, newfolderslist = WallpaperSearch.process_folder(
-                Path(folderlist.pop()))
+            folder = folderlist.pop()
+            if folder in finished:
+                folderlist.extend(finished[folder])
+                continue
+            with metrics.stage("scan.walk"):
+                filelist, newfolderslist = WallpaperSearch.process_folder(folder)
+            if self.checkpoint is not None:
+                self.checkpoint.listed(folder, len(filelist), newfolderslist)
             folderlist.extend(newfolderslist)
-            image_files.extend(filelist)
-        return image_files
+            yield from filelist
 
     @staticmethod
     def process_folder(folder):
         """
             The specified folder will be traversed and a list of images
-            are built into one list with folders in another.
+            with their os.stat results is built with folders in another.
         """
         filelist = []
         folderlist = []
-        for child in folder.iterdir():
-            if child.suffix.lower() in IMAGE_FORMATS and child.is_file():
-                relative_path = child.relative_to(Path.home())
-                filelist.append(relative_path)
-            elif child.is_dir():
-                folderlist.append(child)
-                logging.debug("Found new folder: %s", child.name)
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if os.path.splitext(entry.name)[1].lower() in IMAGE_FORMATS \
+                    and entry.is_file():
+                    filelist.append((entry.path, entry.stat()))
+                elif entry.is_dir():
+                    folderlist.append(entry.path)
+                    logging.debug("Found new folder: %s", entry.name)
         logging.debug("Found images: %s", str(len(filelist)))
         return filelist, folderlist
 
     def process_images(self, image_files):
         """
-            Process the list of image paths, analyse each image and turn
-            the list into a dict. TODO: analyse each image
+            Analyses each (path, stat) pair of image_files and yields a
+            catalog row dict per image. With more than one worker the
+            images are analysed in a process pool holding at most
+            QUEUE_PER_WORKER images per worker, and rows are yielded in
+            input order.
+            In incremental mode images whose size and mtime match the
+            previous scan are reused. Images no longer on disk are dropped
+            because only the paths found by the walk are kept.
+            Other images are looked up in the analysis cache by the hash
+            of their contents and the scale they are decoded at, which
+            analysisMemoryMB can raise per image. A copy of an image still being analysed
+            waits for that result instead of being analysed again.
+            Images which fail analysis are skipped, as are images the
+            header pre-filter rejects or that fit in analysisMemoryMB at
+            no scale, before they are decoded.
+            With readAhead set, the files of the next images to hash or
+            analyse are read into the page cache in the background.
+        """
+        analyse = partial(analyse_image, scale=self.scale, max_bytes=self.max_bytes,
+                          mapped=self.mapped)
+        executor = None
+        if self.workers > 1:
+            executor = ProcessPoolExecutor(max_workers=self.workers)
+            analyse = partial(analyse_image_measured, scale=self.scale,
+                              max_bytes=self.max_bytes, mapped=self.mapped)
+        image_files = readahead(image_files, self.readahead,
+                                lambda item: self.unchanged(*item) is None)
+        queue = deque()
+        reused = cached = rejected = total = 0
+        self.in_flight = set()
+        try:
+            for path_str, stat in image_files:
+                total += 1
+                previous = self.unchanged(path_str, stat)
+                size = self.image_size(path_str, previous)
+                scale = None
+                if size is not None and previous is None:
+                    scale = self.decode_scale(path_str)
+                if size is None or (previous is None and scale is None):
+                    rejected += 1
+                    queue.append((path_str, stat, None, None, None, None))
+                elif previous is not None:
+                    reused += 1
+                    if previous.get('width') is None:
+                        # catalog from before image sizes were stored
+                        previous = dict(previous, **size_fields(*size))
+                    queue.append((path_str, stat, previous, None, size, None))
+                else:
+                    digest = result = None
+                    if self.cache is not None:
+                        digest = self.hash_image(path_str)
+                    if digest is not None:
+                        if digest in self.in_flight:
+                            result = digest
+                        else:
+                            result = self.cache.get(digest, scale)
+                    if result is not None:
+                        cached += 1
+                        queue.append((path_str, stat, result, None, size, scale))
+                    else:
+                        if digest is not None:
+                            self.in_flight.add(digest)
+                        if executor is not None:
+                            result = executor.submit(analyse, path_str, scale=scale)
+                        else:
+                            result = analyse(path_str, scale=scale)
+                        queue.append((path_str, stat, result, digest, size, scale))
+                yield from self.drain(queue, self.workers * QUEUE_PER_WORKER)
+            yield from self.drain(queue, 0)
+        finally:
+            if executor is not None:
+                # analyses not started yet are dropped, shutdown's
+                # cancel_futures needs Python 3.9
+                for _, _, result, *_ in queue:
+                    if hasattr(result, 'cancel'):
+                        result.cancel()
+                executor.shutdown()
+            if self.cache is not None:
+                self.cache.flush()
+        metrics.count("scan.images_reused", reused)
+        metrics.count("scan.images_cached", cached)
+        metrics.count("scan.images_rejected", rejected)
+        metrics.count("scan.images_analysed", total - reused - cached - rejected)
+        logging.debug("Images reused: %i, cached: %i, rejected: %i, analysed: %i",
+                      reused, cached, rejected, total - reused - cached - rejected)
+
+    def drain(self, queue, limit):
+        """
+            Finishes the images at the head of the queue of process_images
+            and yields their rows, in order. Every head entry that is
+            ready, not waiting for a worker, is finished, then entries are
+            waited for until at most limit are left.
+        """
+        while queue and (len(queue) > limit or not hasattr(queue[0][2], 'result')
+                         or queue[0][2].done()):
+            row = self.finish_image(*queue.popleft())
+            if row is not None:
+                yield row
+
+    def unchanged(self, path_str, stat):
+        """
+            Returns the row of the previous scan for an image whose size
+            and mtime have not changed since, or None.
+        """
+        previous = self.previous.get(path_str)
+        if previous is not None \
+            and previous['size'] == stat.st_size \
+            and previous['mtime'] == stat.st_mtime_ns:
+            return previous
+        return None
+
+    def image_size(self, path_str, previous=None):
+        """
+            Returns the (width, height) of an image which passes the
+            pre-filter, or None. The size stored in the previous row is
+            used when there is one, otherwise only the header of the file
+            is read.
+        """
+        if previous is not None and previous.get('width') is not None:
+            size = (previous['width'], previous['height'])
+            return size if large_enough(size, self.min_size) else None
+        with metrics.stage("scan.sniff"):
+            return sniff_image(path_str, self.min_size)
+
+    def decode_scale(self, path_str):
+        """
+            Returns the scale an image is decoded at, the configured one
+            raised to fit in analysisMemoryMB, see fitting_scale. Returns
+            None for an image that fits at no scale.
+        """
+        if not self.max_bytes:
+            return self.scale
+        try:
+            return fitting_scale(path_str, self.scale, self.max_bytes)
+        except (OSError, ValueError) as e_info:
+            logging.warning("Skipping image %s: %s", path_str, repr(e_info))
+            return None
+
+    def hash_image(self, path_str):
+        """
+            Returns the content digest of an image, or None if the file
+            could not be read.
+        """
+        try:
+            with metrics.stage("scan.hash"):
+                return file_digest(path_str)
+        except OSError as e_info:
+            logging.warning("Could not hash image %s: %s", path_str, repr(e_info))
+            return None
+
+    def finish_image(self, path_str, stat, result, digest, size, scale):
+        """
+            Turns one queued image into its catalog row. size is the
+            (width, height) from the pre-filter and scale the scale it
+            is decoded at. result is a
+            reused row, a future, the analysis tuple or the digest of a
+            copy queued earlier whose result is now in the cache. A future
+            returns the analysis with the metrics of the worker, which are
+            merged into this process. New analysis results are stored in
+            the cache under digest and scale. The image is recorded as finished in
+            the checkpoint. Returns None for images which failed analysis
+            or were rejected by the pre-filter.
+        """
+        row = self.finish_row(path_str, stat, result, digest, size, scale)
+        if self.checkpoint is not None:
+            self.checkpoint.finished(path_str, row)
+        return row
+
+    def finish_row(self, path_str, stat, result, digest, size, scale):
+        """
+            Returns the catalog row of finish_image, or None.
         """
-        imagelist = []
-        for path in image_files:
-            #Analyse each image for hues and brightness balance
-            path_str = str(Path(Path.home(), path))
-            image_analyse = ImageAnalysis(path_str)
-            blue, green, red, light, dark = image_analyse.analyse_hsv()
-            dictonary = self.dict_formatter(path_str, blue, green, red, light, dark)
-            imagelist.append(dictonary)
-        data_frame = pandas.DataFrame(imagelist)
-        self.image_data = data_frame.sort_values(['red', 'blue', 'light'])
+        if isinstance(result, dict):
+            return result
+        if isinstance(result, bytes):
+            result = self.cache.get(result, scale)
+        elif hasattr(result, 'result'):
+            result, snapshot = result.result()
+            metrics.METRICS.merge(snapshot)
+        if digest is not None:
+            self.in_flight.discard(digest)
+            if result is not None:
+                self.cache.put(digest, scale, result)
+        if result is None:
+            return None
+        blue, green, red, light, dark, features = result
+        return self.dict_formatter(path_str, blue, green, red, light, dark, stat,
+                                   features, size)
 
-    def save_file(self):
+    def save_file(self, rows):
         """
-            Save the list of images to disk.
+            Streams the catalog rows to disk in chunks.
         """
-        fieldnames = ['path', 'blue', 'green', 'red', 'light', 'dark']
-        self.csv_io.write_file(self.image_data, fieldnames)
+        self.catalog.write_rows(rows, FIELDNAMES)
 
-    def dict_formatter(self, path, blue, green, red, light, dark):
+    def dict_formatter(self, path, blue, green, red, light, dark, stat, features,
+                       size):
         """
             Dictionary object associating fields to the data elements.
-            Note: This way seems terribly inefficient.
+            stat is the os.stat result of the file, used to detect changes
+            on the next incremental scan. The day/night split is worked out
+            here once from the rounded fractions. features is the hex
+            encoded feature vector and size the (width, height) of the
+            image.
         """
-        fieldnames = ['path', 'blue', 'green', 'red', 'light', 'dark']
-        data = [path, round(blue, 3), round(green, 3), round(red, 3),
-                round(light, 3), round(dark, 3)]
-        output = dict(zip(fieldnames, data))
+        blue, green, red = round(blue, 3), round(green, 3), round(red, 3)
+        light, dark = round(light, 3), round(dark, 3)
+        data = [path, blue, green, red, light, dark, stat.st_size,
+                stat.st_mtime_ns, is_night_image(blue, red, light), features]
+        output = dict(zip(FIELDNAMES, data))
+        output.update(size_fields(*size))
         return output
@@ -0,0 +1,101 @@
+"""
+    Minimal Linux inotify bindings used by the watch mode of
+    WallpaperSearch. libc is called through ctypes so no extra package
+    is needed.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+
+# inotify event masks from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+# events watched on every folder of the wallpaper tree
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# wd, mask, cookie and name length header of each event
+EVENT_HEADER = struct.Struct("iIII")
+
+##### Classes
+#####
+class Inotify:
+    """
+        An inotify instance watching a set of folders. Events are read
+        as (path, mask) tuples where path joins the watched folder and
+        the name of the file or folder the event is about.
+    """
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_init1: " + os.strerror(errno))
+        self.watches = {}
+
+    def add_watch(self, folder, mask=WATCH_MASK):
+        """
+            Watches a folder, not its subfolders.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_add_watch: " + os.strerror(errno), folder)
+        self.watches[wd] = folder
+        return wd
+
+    def remove_watch(self, folder):
+        """
+            Stops watching a folder and every folder below it.
+        """
+        prefix = os.path.join(folder, "")
+        for wd, path in list(self.watches.items()):
+            if path == folder or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self, timeout=None):
+        """
+            Waits up to timeout seconds, or forever if None, and returns
+            the list of (path, mask) events that are ready.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflowed, events were lost")
+                events.append((None, mask))
+                continue
+            folder = self.watches.get(wd)
+            if folder is not None:
+                events.append((os.path.join(folder, name), mask))
+        return events
+
+    def close(self):
+        """
+            Closes the inotify instance and all its watches.
+        """
+        os.close(self.fd)
+        self.watches.clear()
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+"""
+    This script runs the local wallpaper selection service. The catalog
+    is loaded once and updatedesktop.py --client, on any number of
+    desktops, asks the service which wallpapers to show.
+"""
+
+import logging
+import argparse
+from desktopchanger import metrics
+from desktopchanger.service import SelectionService
+
+logging.basicConfig(filename=('logs/selectionservice.log'), level=logging.INFO)
+
+##### Argument Parsing
+#####
+def cmd_arguments():
+    """
+        taking CMD arguments and sending them through the argument
+        parser.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--socket",
+                        help="Unix socket path to listen on, serviceSocket in "
+                        "config.yaml by default.")
+    parser.add_argument("--metrics",
+                        help="Write request timings and counters to this file on exit, in "
+                        "the Prometheus text format if it ends in .prom and as json otherwise.")
+    args = parser.parse_args()
+    return args
+
+##### Main
+#####
+if __name__ == "__main__":
+    args = cmd_arguments()
+    service = SelectionService(args)
+    try:
+        service.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info("Request timings:\n%s", metrics.METRICS.summary())
+        if args.metrics:
+            metrics.METRICS.dump(args.metrics)
@@ -10,6 +10,7 @@ Future arguments:
 
 import logging
 import argparse
+from desktopchanger import metrics
 from desktopchanger.desktopchanger import DesktopChanger
 
 logging.basicConfig(filename=('logs/desktopchanger.log'), level=logging.DEBUG)
@@ -24,6 +25,18 @@ def cmd_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--image",
                         help="Full image path can be optionally supplied.")
+    parser.add_argument("-d", "--daemon", action="store_true",
+                        help="Keep running and change the wallpaper every "
+                        "rotationInterval seconds and at sunrise/sunset.")
+    parser.add_argument("-c", "--client", action="store_true",
+                        help="Ask the selection service (selectionservice.py) for "
+                        "the wallpapers instead of reading the catalog.")
+    parser.add_argument("--metrics",
+                        help="Write stage timings and counters to this file, in the "
+                        "Prometheus text format if it ends in .prom and as json otherwise.")
+    parser.add_argument("--profile", nargs="?", const="logs/profile",
+                        help="Profile each stage with cProfile and write one .prof "
+                        "file per stage to this folder (default logs/profile).")
     args = parser.parse_args()
     return args
 
@@ -31,6 +44,19 @@ def cmd_arguments():
 #####
 if __name__ == "__main__":
     args = cmd_arguments()
+    if args.profile:
+        metrics.METRICS.enable_profiling()
     update_desktop = DesktopChanger(args)
-    update_desktop.updater()
+    try:
+        if args.daemon:
+            update_desktop.daemon()
+        else:
+            update_desktop.updater()
+    finally:
+        logging.debug("Stage timings:\n%s", metrics.METRICS.summary())
+        if args.metrics:
+            metrics.METRICS.dump(args.metrics)
+        if args.profile:
+            metrics.METRICS.dump_profiles(args.profile)
+            print(metrics.METRICS.summary())
     print("success")
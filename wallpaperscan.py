@@ -9,6 +9,7 @@
 import logging
 import argparse
 import time
+from desktopchanger import metrics
 from desktopchanger.wallpapersearch import WallpaperSearch
 
 logging.basicConfig(filename=('logs/wallpapercsv.log'), level=logging.DEBUG)
@@ -23,6 +24,24 @@ def cmd_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--folder",
                         help="Full wallpapers folder path can be optionally supplied.")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="Number of worker processes used to analyse images.")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="Only analyse images which are new or changed since the last scan.")
+    parser.add_argument("-s", "--scale", type=int, choices=[1, 2, 4, 8],
+                        help="Decode images reduced by this factor before analysis.")
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help="Carry on from the checkpoint of a scan that was stopped, "
+                        "skipping the images and folders it had finished.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and update the catalog as images are "
+                        "added, changed or removed.")
+    parser.add_argument("--metrics",
+                        help="Write stage timings and counters to this file, in the "
+                        "Prometheus text format if it ends in .prom and as json otherwise.")
+    parser.add_argument("--profile", nargs="?", const="logs/profile",
+                        help="Profile each stage with cProfile and write one .prof "
+                        "file per stage to this folder (default logs/profile).")
     args = parser.parse_args()
     return args
 
@@ -31,8 +50,21 @@ def cmd_arguments():
 if __name__ == "__main__":
     start_time = time.time()
     ARGS = cmd_arguments()
+    if ARGS.profile:
+        metrics.METRICS.enable_profiling()
     image_loader = WallpaperSearch(ARGS)
-    image_loader.search_folder()
+    try:
+        if ARGS.watch:
+            image_loader.watch()
+        else:
+            image_loader.search_folder()
+    finally:
+        logging.debug("Stage timings:\n%s", metrics.METRICS.summary())
+        if ARGS.metrics:
+            metrics.METRICS.dump(ARGS.metrics)
+        if ARGS.profile:
+            metrics.METRICS.dump_profiles(ARGS.profile)
+            print(metrics.METRICS.summary())
     end_time = time.time()
     logging.debug("--- %s seconds --- {}", (end_time - start_time))
     print("--- %s seconds ---" % (end_time - start_time))